@@ -6,10 +6,8 @@ from __future__ import print_function
 import os
 import json
 
-import sqlite3
-
 # Third-party libraries
-from flask import Flask, redirect, request, url_for, render_template
+from flask import Flask, jsonify, redirect, request, url_for, render_template
 from flask_login import (
     LoginManager,
     current_user,
@@ -20,9 +18,11 @@ from flask_login import (
     )
 from oauthlib.oauth2 import WebApplicationClient
 import requests
+import sqlalchemy
 
 # Internal imports
 from etl.gcp_utils import init_connection_engine, access_secret
+from etl.db_pool import pool_metrics
 from data_viz import journal_calendar
 
 
@@ -37,17 +37,21 @@ try:
 except: # google.api_core.exceptions.PermissionDenied
     GOOGLE_CLIENT_ID = os.getenv("CLIENT_ID")
     GOOGLE_CLIENT_SECRET = os.getenv("CLIENT_SECRET")
-    LOCAL_DB = os.getenv("LOCAL_DB")
     EMAIL = os.getenv("EMAIL")
 
 finally:
     GOOGLE_DISCOVERY_URL = 'https://accounts.google.com/.well-known/openid-configuration'
+    LOCAL_DB = os.getenv("LOCAL_DB")
+
+    # Run against the local SQLite database when no server database is configured.
+    if LOCAL_DB and not os.getenv("DB_HOST"):
+        os.environ.setdefault("DB_URL", f"sqlite:///{LOCAL_DB}")
+
     DB_URL = os.getenv('DB_URL')
 
 
-# TODO: Resolve testing with this initial database declaration.
+# Engine of the app database, created on first use.
 db = None
-db= sqlite3
 
 app = Flask(__name__)
 app.secret_key = os.getenv("SECRET_KEY") or os.urandom(24)
@@ -157,10 +161,16 @@ def codex_vitae():
         global db
         db = db or init_connection_engine()
 
-        with db.connect(LOCAL_DB) as conn:
-            journal_tuples = conn.execute(
-                                        "select * from journal_view order by date"
-                                        ).fetchall()
+        # SQLite has the journal view itself; server databases hold its synced copy.
+        journal_table = 'journal_view' if db.dialect.name == 'sqlite' else 'journal_prod'
+
+        with pool_metrics(db).connect() as conn:
+            journal_tuples = conn.execute(sqlalchemy.text(
+                                        f"select date, mood, entry from {journal_table} order by date"
+                                        )).fetchall()
+
+        # Server databases return dates as date objects rather than ISO strings.
+        journal_tuples = [(str(date), mood, entry) for date, mood, entry in journal_tuples]
 
         journal = journal_calendar(journal_tuples)
 
@@ -168,6 +178,16 @@ def codex_vitae():
     return "Please Log In."
 
 
+@app.route('/pool-metrics')
+@login_required
+def pool_health():
+    # Connection pool health of the app database, e.g. waits and timeouts for a connection.
+    if db is None:
+        return jsonify({})
+
+    return jsonify(pool_metrics(db).snapshot())
+
+
 if __name__ == '__main__':
 
     app.run(ssl_context="adhoc",debug=True)
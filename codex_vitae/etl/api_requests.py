@@ -3,17 +3,50 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import re
+import json
 import base64
+import sqlite3
+import threading
 import requests
 
 from contextlib import closing
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
 
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 
 
+# Partial response fields for message bodies, so headers and metadata are not downloaded.
+BODY_FIELDS = 'id,internalDate,payload(body/data,parts/body/data)'
+
+_local = threading.local()
+
+
+class EmailBody(str):
+    """Decoded email body, carrying the message id and the UTC date the email was sent.
+
+    Args:
+        text: A string of the UTF-8 decoded email body.
+        id_: A string containing the GMail message id.
+        internal_date: Milliseconds since the epoch when GMail received the message.
+    """
+
+    def __new__(cls, text, id_=None, internal_date=None):
+        body = super().__new__(cls, text)
+        body.id = id_
+        body.sent = None if internal_date is None else datetime.fromtimestamp(int(internal_date) / 1000, tz=timezone.utc).date()
+
+        return body
+
+
 def authenticate_gmail_api(credentials):
     """Authenticate email API from credentials declared from an env variable.
 
@@ -51,47 +84,376 @@ def authenticate_gmail_api(credentials):
     return service
 
 
-def get_email_content(service, query = None):
-    """Use the GMail API to query email bodies and decode into string format.
+def _message_body(message):
+    """Return the base64url-encoded body of a message, using the HTML part of container MIME messages."""
+
+    payload = message.get('payload')
+    body = payload.get('body', {}).get('data')
+
+    if body is None:
+        parts = payload.get('parts')
+        body = parts[1].get('body').get('data')
+
+    return body
+
+
+def _thread_http(service):
+    """Return an HTTP object for the current thread, since httplib2 is not thread-safe."""
+
+    credentials = getattr(getattr(service, '_http', None), 'credentials', None)
+
+    if credentials is None:
+        return None
+
+    if not hasattr(_local, 'http'):
+        _local.http = AuthorizedHttp(credentials, http=httplib2.Http())
+
+    return _local.http
+
+
+def get_messages(service, id_list, batch_size=50, max_workers=8, fields=BODY_FIELDS):
+    """Fetch GMail messages with batch HTTP requests, falling back to a thread pool.
+
+    Args:
+        service: GMail API service object.
+        id_list: A list of message id strings.
+        batch_size: Number of messages per batch request. If 0, skip batching and
+            fetch every message in the thread pool.
+        max_workers: Maximum number of threads for messages fetched individually.
+        fields: A string containing the partial response fields to download.
+
+    Returns:
+        messages: A list of message resources in the same order as id_list.
+    """
+
+    def request(id_):
+        return service.users().messages().get(userId='me', id=id_, format='full', fields=fields)
+
+    messages = {}
+
+    def callback(request_id, response, exception):
+        if exception is None:
+            messages[request_id] = response
+
+    if batch_size:
+        for i in range(0, len(id_list), batch_size):
+            batch = service.new_batch_http_request(callback=callback)
+
+            for id_ in id_list[i:i+batch_size]:
+                batch.add(request(id_), request_id=id_)
+
+            batch.execute()
+
+    # Messages that were not batched, or failed within a batch, are fetched individually.
+    missing = [id_ for id_ in id_list if id_ not in messages]
+
+    if missing:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            fetched = executor.map(lambda id_: request(id_).execute(http=_thread_http(service)), missing)
+            messages.update(zip(missing, fetched))
+
+    return [messages[id_] for id_ in id_list]
+
+
+def list_message_ids(service, query=None, page_size=100):
+    """Use the GMail API to list message ids for a query, following page tokens until exhausted.
 
     Args:
         service: GMail API service object.
         query: A string containing GMail search syntax.
-    
+        page_size: Maximum number of message ids per page (at most 500).
+
+    Yields:
+        id_list: A list of message id strings for each page of results.
+    """
+
+    page_token = None
+
+    while True:
+        response = service.users().messages().list(
+            userId='me',
+            q=query,
+            maxResults=page_size,
+            includeSpamTrash=False,
+            pageToken=page_token,
+            ).execute()
+
+        id_list = [id['id'] for id in response.get('messages', [])]
+
+        if id_list:
+            yield id_list
+
+        page_token = response.get('nextPageToken')
+
+        if page_token is None:
+            return
+
+
+# Date window terms of a GMail query, e.g. ",after:2022-01-01". Listings are kept per
+# query without its window, so a window moving forward every day reuses one listing.
+_WINDOW_RE = re.compile(r'[\s,]*\b(after|before):(\S+?)(?=[\s,]|$)')
+
+# GMail evaluates dates in the mailbox time zone, so windows are applied with a day of slack.
+_DAY_MS = 24 * 60 * 60 * 1000
+
+# History ids expire after about a week, after which a stored listing can never be reused.
+_HISTORY_TTL = 7 * 24 * 60 * 60
+
+
+def _epoch_ms(value):
+    """Convert a GMail date (YYYY/MM/DD, YYYY-MM-DD or epoch seconds) to epoch milliseconds."""
+
+    if value.isdigit():
+        return int(value) * 1000
+
+    day = datetime.strptime(value.replace('/', '-'), '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+    return int(day.timestamp() * 1000)
+
+
+def _query_window(query):
+    """Split a GMail query into the query without its date window and the window bounds.
+
     Returns:
-        decoded_list: A list of email bodies.
+        key: A string containing the query without after: and before: terms.
+        after: Epoch milliseconds of the after: date, or None.
+        before: Epoch milliseconds of the before: date, or None.
     """
 
-    # Call the Gmail API
-    emails = service.users().messages().list(userId='me',q=query, maxResults=101,includeSpamTrash=False).execute()
-    emails = emails.get('messages')
+    window = {}
 
-    if emails is not None:
+    def drop(match):
+        window[match.group(1)] = _epoch_ms(match.group(2))
+        return ''
 
-        id_list = [id['id'] for id in emails]
+    try:
+        key = _WINDOW_RE.sub(drop, str(query))
+    # A window GMail understands but this does not is kept in the key instead.
+    except ValueError:
+        return str(query), None, None
 
-        body_list = []
+    return key, window.get('after'), window.get('before')
 
-        # Check for container MIME message parts.
-        body = service.users().messages().get(userId='me',id=id_list[0]).execute().get('payload').get('body').get('data')
 
-        if body == None:
-            for email in id_list:
-                body = service.users().messages().get(userId='me',id=email).execute().get('payload').get('parts')
-                text = body[0].get('body').get('data')
-                html = body[1].get('body').get('data')
-                body = tuple((text,html))
-                body_list.append(html)
-            
-        else:
-            for email in id_list:
-                body = service.users().messages().get(userId='me',id=email).execute().get('payload').get('body').get('data')
-                body_list.append(body)
+class MessageCache:
+    """Cache decoded GMail message bodies in SQLite, keyed by message id.
+
+    reMarkable and MyNetDiary emails never change after delivery, so each body only
+    needs to be downloaded once. The listing of each query is stored with the mailbox
+    history id, keyed by the query without its date window, so a repeated query skips
+    listing messages unless mail matching it has arrived since.
+
+    Args:
+        db_path: A string containing the full directory and database name.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+        with closing(sqlite3.connect(db_path)) as con:
+            con.executescript("""
+                CREATE TABLE IF NOT EXISTS message_cache(
+                    id text PRIMARY KEY,
+                    internal_date integer,
+                    body blob NOT NULL
+                );
+
+                CREATE TABLE IF NOT EXISTS message_listing(
+                    key text PRIMARY KEY,
+                    query text NOT NULL,
+                    history_id text NOT NULL,
+                    ids text NOT NULL,
+                    synced_at integer NOT NULL
+                );
+                """)
+
+    def get(self, id_list: list) -> dict:
+        """Return cached messages as a dictionary of ids and (internal_date, body) tuples."""
+
+        with closing(sqlite3.connect(self.db_path)) as con:
+            rows = con.execute(
+                f"SELECT id, internal_date, body FROM message_cache WHERE id IN ({', '.join('?' * len(id_list))})",
+                id_list,
+                ).fetchall()
+
+        return {id_: (internal_date, body) for id_, internal_date, body in rows}
+
+    def put(self, messages: dict):
+        """Store a dictionary of message ids and (internal_date, body) tuples."""
+
+        with closing(sqlite3.connect(self.db_path)) as con:
+            with con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO message_cache (id, internal_date, body) VALUES (?, ?, ?)",
+                    [(id_, internal_date, body) for id_, (internal_date, body) in messages.items()],
+                    )
+
+    def _messages_added(self, service, history_id):
+        """Return the ids of messages added to the mailbox since history_id, or None if it expired."""
+
+        added = set()
+        page_token = None
+
+        try:
+            while True:
+                response = service.users().history().list(
+                    userId='me',
+                    startHistoryId=history_id,
+                    historyTypes='messageAdded',
+                    pageToken=page_token,
+                    ).execute()
+
+                for record in response.get('history', []):
+                    added.update(message['message']['id'] for message in record.get('messagesAdded', []))
+
+                page_token = response.get('nextPageToken')
+
+                if page_token is None:
+                    return added
+
+        # History ids expire after about a week, after which a full listing is required.
+        except HttpError:
+            return None
+
+    def _in_window(self, id_list, after, before):
+        """Drop listed messages that were sent outside a date window, going by their cached sent dates."""
+
+        if after is None and before is None:
+            return id_list
+
+        with closing(sqlite3.connect(self.db_path)) as con:
+            sent = dict(con.execute(
+                f"SELECT id, internal_date FROM message_cache WHERE id IN ({', '.join('?' * len(id_list))})",
+                id_list,
+                ).fetchall())
+
+        return [id_ for id_ in id_list
+                if sent.get(id_) is None
+                or ((after is None or int(sent[id_]) >= after - _DAY_MS)
+                    and (before is None or int(sent[id_]) < before + _DAY_MS))]
+
+    def list_message_ids(self, service, query=None, page_size=100):
+        """List message ids for a query, reusing the previous listing if no matching mail has arrived since.
+
+        A listing made for a wider date window is reused for a narrower one, such as
+        the same window moved forward a day, dropping messages sent outside it.
+
+        Args:
+            service: GMail API service object.
+            query: A string containing GMail search syntax.
+            page_size: Maximum number of message ids per page.
+
+        Yields:
+            id_list: A list of message id strings for each page of results.
+        """
+
+        # Read the history id first, so mail arriving during the sync is seen next time.
+        history_id = service.users().getProfile(userId='me').execute().get('historyId')
+        key, after, before = _query_window(query)
+        synced_at = int(datetime.now(timezone.utc).timestamp())
+
+        with closing(sqlite3.connect(self.db_path)) as con:
+            state = con.execute("SELECT query, history_id, ids FROM message_listing WHERE key = ?", (key,)).fetchone()
+
+        pages = list_message_ids(service, query=query, page_size=page_size)
+        first_page = []
+        id_list = None
+
+        if state is not None:
+            _, listed_after, listed_before = _query_window(state[0])
+            covered = ((listed_after is None or (after is not None and after >= listed_after))
+                       and (listed_before is None or (before is not None and before <= listed_before)))
+            added = self._messages_added(service, state[1]) if covered else None
+
+            # New mail is listed first, so any of it matching the query is on the first page.
+            if added:
+                first_page = next(pages, [])
+
+            if added is not None and len(added) < page_size and added.isdisjoint(first_page):
+                id_list = self._in_window(json.loads(state[2]), after, before)
+
+        if id_list is None:
+            id_list = first_page + [id_ for page in pages for id_ in page]
+
+        with closing(sqlite3.connect(self.db_path)) as con:
+            with con:
+                con.execute("INSERT OR REPLACE INTO message_listing (key, query, history_id, ids, synced_at) VALUES (?, ?, ?, ?, ?)",
+                            (key, str(query), history_id, json.dumps(id_list), synced_at))
+                con.execute("DELETE FROM message_listing WHERE synced_at < ?", (synced_at - _HISTORY_TTL,))
+
+        for i in range(0, len(id_list), page_size):
+            yield id_list[i:i+page_size]
+
+
+def iter_email_content(service, query = None, page_size=100, batch_size=50, max_workers=8, cache=None):
+    """Use the GMail API to stream email bodies for a query one page of results at a time.
+
+    Only one page of messages is held in memory, and every matching email is
+    returned regardless of how many pages the query spans.
+
+    Args:
+        service: GMail API service object.
+        query: A string containing GMail search syntax.
+        page_size: Maximum number of messages listed and fetched per page.
+        batch_size: Number of messages per batch request, or 0 to use a thread pool.
+        max_workers: Maximum number of threads for messages fetched individually.
+        cache: Optional MessageCache. Only messages missing from it are downloaded.
+
+    Yields:
+        email: An EmailBody string of the UTF-8 decoded email body, with its sent date.
+    """
+
+    if cache is None:
+        pages = list_message_ids(service, query=query, page_size=page_size)
+    else:
+        pages = cache.list_message_ids(service, query=query, page_size=page_size)
+
+    for id_list in pages:
+        cached = {} if cache is None else cache.get(id_list)
+        missing = [id_ for id_ in id_list if id_ not in cached]
+
+        if missing:
+            messages = get_messages(service, missing, batch_size=batch_size, max_workers=max_workers)
+            fetched = {
+                id_: (message.get('internalDate'), base64.urlsafe_b64decode(bytes(str(_message_body(message)),encoding='utf-8')))
+                for id_, message in zip(missing, messages)
+                }
+
+            if cache is not None:
+                cache.put(fetched)
+
+            cached.update(fetched)
+
+        # Bodies are decoded as UTF-8 one at a time, as they are consumed.
+        for id_ in id_list:
+            internal_date, body = cached[id_]
+            yield EmailBody(body.decode('utf-8', errors='replace'), id_, internal_date)
+
+
+def get_email_content(service, query = None, page_size=100, batch_size=50, max_workers=8, cache=None):
+    """Use the GMail API to query email bodies and decode into string format.
+
+    Args:
+        service: GMail API service object.
+        query: A string containing GMail search syntax.
+        page_size: Maximum number of messages listed and fetched per page.
+        batch_size: Number of messages per batch request, or 0 to use a thread pool.
+        max_workers: Maximum number of threads for messages fetched individually.
+        cache: Optional MessageCache. Only messages missing from it are downloaded.
+    
+    Returns:
+        str_list: A list of email bodies, or None if no emails match the query.
+    """
 
-        bytes_list = [bytes(str(x),encoding='utf-8') for x in body_list]
-        decoded_list = [base64.urlsafe_b64decode(x) for x in bytes_list]
-        str_list = [str(x) for x in decoded_list]
+    str_list = list(iter_email_content(service,
+                                       query=query,
+                                       page_size=page_size,
+                                       batch_size=batch_size,
+                                       max_workers=max_workers,
+                                       cache=cache,
+                                       ))
 
+    if str_list:
         return str_list
 
     service.close()
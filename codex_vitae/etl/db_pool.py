@@ -0,0 +1,162 @@
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+import sqlalchemy
+
+
+# Connection pool profiles, chosen with the DB_POOL_PROFILE environment variable.
+POOL_PROFILES = {
+    # Dashboard traffic from the Flask app.
+    "web": {
+        # [START cloud_sql_mysql_sqlalchemy_limit]
+        # Pool size is the maximum number of permanent connections to keep.
+        "pool_size": 2,
+        # Temporarily exceeds the set pool_size if no connections are available.
+        "max_overflow": 1,
+        # The total number of concurrent connections for your application will be
+        # a total of pool_size and max_overflow.
+        # [END cloud_sql_mysql_sqlalchemy_limit]
+
+        # [START cloud_sql_mysql_sqlalchemy_backoff]
+        # SQLAlchemy automatically uses delays between failed connection attempts,
+        # but provides no arguments for configuration.
+        # [END cloud_sql_mysql_sqlalchemy_backoff]
+
+        # [START cloud_sql_mysql_sqlalchemy_timeout]
+        # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
+        # new connection from the pool. After the specified amount of time, an
+        # exception will be thrown.
+        "pool_timeout": 30,  # 30 seconds
+        # [END cloud_sql_mysql_sqlalchemy_timeout]
+
+        # [START cloud_sql_mysql_sqlalchemy_lifetime]
+        # 'pool_recycle' is the maximum number of seconds a connection can persist.
+        # Connections that live longer than the specified amount of time will be
+        # reestablished
+        "pool_recycle": 1800,  # 30 minutes
+        # [END cloud_sql_mysql_sqlalchemy_lifetime]
+    },
+    # Bulk loads hold a single connection for long transactions.
+    "etl": {
+        "pool_size": 1,
+        "max_overflow": 0,
+        "pool_timeout": 120,
+        "pool_recycle": 3600,
+    },
+    # Tests fail fast instead of waiting on a connection.
+    "test": {
+        "pool_size": 1,
+        "max_overflow": 0,
+        "pool_timeout": 5,
+        "pool_recycle": 300,
+    },
+}
+
+
+class PoolMetrics:
+    """Collect connection pool health metrics from SQLAlchemy pool events.
+
+    Checkouts, checkins and how long connections are held are recorded from pool
+    events. Waits for a connection, and timeouts when none becomes available, are
+    recorded by connecting through the connect method.
+
+    Args:
+        engine: SQLAlchemy engine whose pool is instrumented.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.overflow_checkouts = 0
+        self.timeouts = 0
+        self.max_overflow_used = 0
+        self.hold_seconds = 0.0
+        # Waits of the most recent checkouts.
+        self.wait_seconds = deque(maxlen=1000)
+
+        sqlalchemy.event.listen(engine, "checkout", self._on_checkout)
+        sqlalchemy.event.listen(engine, "checkin", self._on_checkin)
+
+    def _overflow(self):
+        """Return the number of connections open beyond pool_size, or 0 for pools without overflow."""
+
+        overflow = getattr(self.engine.pool, "overflow", None)
+
+        return max(overflow(), 0) if overflow else 0
+
+    def _on_checkout(self, dbapi_connection, connection_record, connection_proxy):
+        connection_record.info["checkout_time"] = time.perf_counter()
+        overflow = self._overflow()
+
+        with self._lock:
+            self.checkouts += 1
+            self.overflow_checkouts += overflow > 0
+            self.max_overflow_used = max(self.max_overflow_used, overflow)
+
+    def _on_checkin(self, dbapi_connection, connection_record):
+        checkout_time = connection_record.info.pop("checkout_time", None)
+
+        with self._lock:
+            self.checkins += 1
+            if checkout_time is not None:
+                self.hold_seconds += time.perf_counter() - checkout_time
+
+    @contextmanager
+    def connect(self):
+        """Check out a connection, timing the wait and counting pool timeouts."""
+
+        start = time.perf_counter()
+
+        try:
+            connection = self.engine.connect()
+        except sqlalchemy.exc.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            raise
+        finally:
+            with self._lock:
+                self.wait_seconds.append(time.perf_counter() - start)
+
+        with connection:
+            yield connection
+
+    def snapshot(self):
+        """Return the current metrics as a dictionary."""
+
+        pool = self.engine.pool
+
+        with self._lock:
+            waits = sorted(self.wait_seconds)
+
+            return {
+                "pool_size": pool.size() if hasattr(pool, "size") else None,
+                "checked_out": pool.checkedout() if hasattr(pool, "checkedout") else None,
+                "overflow": self._overflow(),
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "overflow_checkouts": self.overflow_checkouts,
+                "max_overflow_used": self.max_overflow_used,
+                "timeouts": self.timeouts,
+                "mean_hold_seconds": self.hold_seconds / self.checkins if self.checkins else 0.0,
+                "mean_wait_seconds": sum(waits) / len(waits) if waits else 0.0,
+                "p95_wait_seconds": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            }
+
+
+# Metrics of each instrumented engine, shared by everything using it.
+_pool_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+def pool_metrics(engine):
+    """Return the PoolMetrics of an engine, instrumenting its pool on first use."""
+
+    with _metrics_lock:
+        if engine not in _pool_metrics:
+            _pool_metrics[engine] = PoolMetrics(engine)
+
+    return _pool_metrics[engine]
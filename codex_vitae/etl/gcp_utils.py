@@ -1,7 +1,8 @@
 import os
 
 from google.cloud import storage, secretmanager
-from etl.orm_inserts import orm_init
+from etl.orm_inserts import get_engine
+from etl.db_pool import POOL_PROFILES, pool_metrics
 
 import sqlalchemy
 
@@ -33,44 +34,28 @@ def access_secret(project_id:str,secret_id:str, version_id='latest'):
     return response.payload.data.decode('UTF-8')
 
 
-def init_connection_engine():
-    db_config = {
-        # [START cloud_sql_mysql_sqlalchemy_limit]
-        # Pool size is the maximum number of permanent connections to keep.
-        "pool_size": 2,
-        # Temporarily exceeds the set pool_size if no connections are available.
-        "max_overflow": 1,
-        # The total number of concurrent connections for your application will be
-        # a total of pool_size and max_overflow.
-        # [END cloud_sql_mysql_sqlalchemy_limit]
-
-        # [START cloud_sql_mysql_sqlalchemy_backoff]
-        # SQLAlchemy automatically uses delays between failed connection attempts,
-        # but provides no arguments for configuration.
-        # [END cloud_sql_mysql_sqlalchemy_backoff]
-
-        # [START cloud_sql_mysql_sqlalchemy_timeout]
-        # 'pool_timeout' is the maximum number of seconds to wait when retrieving a
-        # new connection from the pool. After the specified amount of time, an
-        # exception will be thrown.
-        "pool_timeout": 30,  # 30 seconds
-        # [END cloud_sql_mysql_sqlalchemy_timeout]
-
-        # [START cloud_sql_mysql_sqlalchemy_lifetime]
-        # 'pool_recycle' is the maximum number of seconds a connection can persist.
-        # Connections that live longer than the specified amount of time will be
-        # reestablished
-        "pool_recycle": 1800,  # 30 minutes
-        # [END cloud_sql_mysql_sqlalchemy_lifetime]
-
-    }
+def init_connection_engine(profile=None):
+    """Return the process-wide engine for the app database, created on first use and shared with the ETL.
+
+    Args:
+        profile: Name of the pool profile in POOL_PROFILES. Defaults to DB_POOL_PROFILE, or web.
+
+    Returns:
+        Instrumented SQLAlchemy engine. Its metrics are available from pool_metrics.
+    """
+
+    db_config = POOL_PROFILES[profile or os.environ.get("DB_POOL_PROFILE", "web")]
 
     if os.environ.get("DB_HOST"):
-        return init_tcp_connection_engine(db_config)
+        engine = init_tcp_connection_engine(db_config)
     elif os.environ.get("DB_URL"):
-        return orm_init()
+        engine = get_engine(os.environ["DB_URL"], **db_config)
     else:
-        return init_unix_connection_engine(db_config)
+        engine = init_unix_connection_engine(db_config)
+
+    pool_metrics(engine)
+
+    return engine
 
 
 def init_tcp_connection_engine(db_config):
@@ -87,7 +72,7 @@ def init_tcp_connection_engine(db_config):
     host_args = db_host.split(":")
     db_hostname, db_port = host_args[0], int(host_args[1])
 
-    pool = sqlalchemy.create_engine(
+    pool = get_engine(
         # Equivalent URL:
         # mysql+pymysql://<db_user>:<db_pass>@<db_host>:<db_port>/<db_name>
         sqlalchemy.engine.url.URL.create(
@@ -116,7 +101,7 @@ def init_unix_connection_engine(db_config):
     db_socket_dir = os.environ.get("DB_SOCKET_DIR", "/cloudsql")
     cloud_sql_connection_name = os.environ["CLOUD_SQL_CONNECTION_NAME"]
 
-    pool = sqlalchemy.create_engine(
+    pool = get_engine(
         # Equivalent URL:
         # mysql+pymysql://<db_user>:<db_pass>@/<db_name>?unix_socket=<socket_path>/<cloud_sql_instance_name>
         sqlalchemy.engine.url.URL.create(
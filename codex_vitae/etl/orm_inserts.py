@@ -1,169 +1,308 @@
 import os
 import csv
+import sqlite3
 import datetime
+import itertools
+import threading
 
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from contextlib import closing
+
+from sqlalchemy import create_engine, inspect, select, text
+from sqlalchemy.engine import make_url
 #from sqlalchemy.ext.declarative import declarative_base
 #from sqlalchemy import Column, Text, Float, Integer, Date
 
+from etl.sqlite_module import db_connect
 from etl.orm_models import Base, MoodCharts, BulletJournal, ExistJournal, reMarkable, JournalProd, RescueTimeProd
 
 # Declare environment variables.
-DB_URL = os.getenv('DB_URL')
 DIR = os.getenv('APP_DIR')
 
+# Connection pool settings for server databases, sized for the Cloud SQL connection limits.
+POOL_SETTINGS = {
+    'pool_size': 2,
+    'max_overflow': 1,
+    'pool_timeout': 30,
+    'pool_recycle': 1800,
+    'pool_pre_ping': True,
+}
+
+# Engines are created on first use and shared by the whole process, one per database URL and pool settings.
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(url=None, **pool_settings):
+    """Return the process-wide SQLAlchemy engine for a database and pool settings, creating it on first use.
+
+    Asking for the same database with different pool settings, e.g. another profile
+    in POOL_PROFILES, returns a separate engine with its own pool.
+
+    Args:
+        url: Database URL string or URL object. Defaults to the DB_URL environment variable.
+        **pool_settings: Pool arguments overriding POOL_SETTINGS.
+
+    Returns:
+        engine: SQLAlchemy engine.
+    """
+
+    url = make_url(url or os.getenv('DB_URL'))
+
+    # In-memory SQLite pools are chosen by the dialect and take no sizing arguments.
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        settings = {}
+    else:
+        settings = {**POOL_SETTINGS, **pool_settings}
+
+    key = (url, tuple(sorted(settings.items())))
+
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = create_engine(url, **settings)
+
+    return _engines[key]
+
+
 def orm_init():
-    """Create SQLAlchemy session for DB activities."""
+    """Return the shared SQLAlchemy engine for DB activities."""
     
-    return create_engine(DB_URL)
-
+    return get_engine()
 
-def insert_mood_charts(engine=orm_init()):
 
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+def _csv_batches(csv_path, columns, rename, batch_size):
+    """Read a CSV file into batches of dictionaries keyed by table column."""
 
-    with open(f"{DIR}/mood_charts.csv", 'r') as f:
+    with open(csv_path, 'r') as f:
         csv_reader = csv.DictReader(f)
+        rename = {field.lower(): col for field, col in rename.items()}
+        fields = {field: rename.get(field.lower(), field.lower()) for field in csv_reader.fieldnames}
+        fields = {field: col for field, col in fields.items() if col in columns}
+
+        batch = []
 
         for row in csv_reader:
-            db_record = MoodCharts(
-                date = datetime.datetime.strptime(row['Date'],"%Y-%m-%d"),
-                mood = row['Mood'],
-                sleep = row['Sleep'],
-                cardio = row['Cardio'],
-                mood_note = row['Mood_Note'],
-            )
-            session.add(db_record)
+            record = {col: row[field] or None for field, col in fields.items()}
 
-    session.commit()
-    session.close()
+            if record.get('date') is not None:
+                record['date'] = datetime.date.fromisoformat(record['date'][:10])
 
+            batch.append(record)
 
-def insert_bullet_journal(engine=orm_init()):
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
 
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+        if batch:
+            yield batch
 
-    with open(f"{DIR}/bullet_journal.csv", 'r') as f:
-        csv_reader = csv.DictReader(f)
 
-        for row in csv_reader:
-            db_record = BulletJournal(
-                date = datetime.datetime.strptime(row['Date'],"%Y-%m-%d"),
-                mood = row['Mood'],
-                sleep = row['Sleep'],
-                steps = row['Steps'],
-                cardio = row['Cardio'],
-                meditate = row['Meditate'],
-                mood_note = row['Mood_Note'],
-                fasting = row['Fasting'],
-                cheat_meals = row['Cheat_Meals'],
-                read = row['Read'],
-                draw = row['Draw'],
-                learn = row['Learn'],
-                write = row['Write'],
-                guitar = row['Guitar'],
-            )
-            session.add(db_record)
+def bulk_load_csv(model, csv_path, rename=None, batch_size=1000, engine=None):
+    """Load a CSV file into the table of a model, one executemany round trip per batch.
 
-    session.commit()
-    session.close()
+    CSV headers are matched to columns case-insensitively, and empty fields are loaded as NULL.
+    Rows are upserted, so dates already in the table are replaced and reloading is harmless.
 
+    Args:
+        model: Declarative model class of the destination table.
+        csv_path: A string containing the filepath of the CSV file.
+        rename: Optional dictionary of CSV headers (in any case) and the columns they are loaded into.
+        batch_size: Number of rows upserted per round trip.
+        engine: SQLAlchemy engine. Defaults to the shared engine for DB_URL.
 
-def insert_exist_journal(engine=orm_init()):
+    Returns:
+        row_count: Integer of rows loaded.
+    """
 
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+    engine = engine or orm_init()
+    table = model.__table__
 
-    with open(f"{DIR}/exist_journal.csv", 'r') as f:
-        csv_reader = csv.DictReader(f)
+    Base.metadata.create_all(engine, tables=[table])
+    _add_hash_column(engine, table)
 
-        for row in csv_reader:
-            db_record = ExistJournal(
-                date = datetime.datetime.strptime(row['date'],"%Y-%m-%d"),
-                mood = row['mood'],
-                entry = row['mood_note'],
-            )
-            session.add(db_record)
+    row_count = 0
 
-    session.commit()
-    session.close()
+    with engine.begin() as con:
+        stmt = upsert_statement(engine, table)
 
+        for batch in _csv_batches(csv_path, set(table.columns.keys()), rename or {}, batch_size):
+            con.execute(stmt, batch)
+            row_count += len(batch)
 
-def insert_remarkable(engine=orm_init()):
+    return row_count
 
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
 
-    with open(f"{DIR}/remarkable.csv", 'r') as f:
-        csv_reader = csv.DictReader(f)
+def upsert_statement(engine, table):
+    """Build an insert for a table that updates rows whose primary key already exists.
 
-        for row in csv_reader:
-            db_record = reMarkable(
-                date = datetime.datetime.strptime(row['date'],"%Y-%m-%d"),
-                mood = row['mood'],
-                entry = row['entry'],
-            )
-            session.add(db_record)
+    Args:
+        engine: SQLAlchemy engine of the target database.
+        table: SQLAlchemy Table object.
 
-    session.commit()
-    session.close()
+    Returns:
+        stmt: Insert statement using ON DUPLICATE KEY UPDATE (MySQL) or ON CONFLICT DO UPDATE
+            (PostgreSQL and SQLite).
+    """
 
+    dialect = engine.dialect.name
+    keys = [col.name for col in table.primary_key.columns]
 
-def insert_journal_prod(engine=orm_init()):
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
 
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update({col.name: stmt.inserted[col.name] for col in table.columns if col.name not in keys})
 
-    with open(f"{DIR}/journal_prod.csv", 'r') as f:
-        csv_reader = csv.DictReader(f)
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError(f"Upserts are not supported for the {dialect} dialect.")
 
-        for row in csv_reader:
-            db_record = JournalProd(
-                date = datetime.datetime.strptime(row['date'],"%Y-%m-%d"),
-                mood = row['mood'],
-                entry = row['entry'],
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={col.name: stmt.excluded[col.name] for col in table.columns if col.name not in keys},
+        )
+
+
+def _sqlite_rows(sqlite_path, source, columns, batch_size=1000):
+    """Stream rows of a SQLite table or view in date order as dictionaries, with the content hash of each row."""
+
+    with closing(db_connect(sqlite_path, pragmas={})) as con:
+        cur = con.execute(
+            f"SELECT {', '.join(columns)}, hash_row({', '.join(columns)}) FROM {source} ORDER BY date"
             )
-            session.add(db_record)
 
-    session.commit()
-    session.close()
+        for batch in iter(lambda: cur.fetchmany(batch_size), []):
+            for row in batch:
+                record = dict(zip(columns + ['row_hash'], row))
+                record['date'] = datetime.date.fromisoformat(record['date'][:10])
 
+                yield record
 
-def insert_rescuetime_prod(engine=orm_init()):
 
-    Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
+def _add_hash_column(engine, table):
+    """Add the row_hash column to a target table created before synced rows were hashed."""
 
-    with open(f"{DIR}/rescuetime_prod.csv", 'r') as f:
-        csv_reader = csv.DictReader(f)
+    if 'row_hash' in {col['name'] for col in inspect(engine).get_columns(table.name)}:
+        return
 
-        for row in csv_reader:
-            db_record = RescueTimeProd(
-                date = datetime.datetime.strptime(row['date'],"%Y-%m-%d"),
-                prd_hours = row['prd_hours'],
-                dst_hours = row['dst_hours'],
-                neut_hours = row['neut_hours'],
-            )
-            session.add(db_record)
+    with engine.begin() as con:
+        con.execute(text(f"ALTER TABLE {table.name} ADD COLUMN row_hash {table.c.row_hash.type.compile(engine.dialect)}"))
+
+
+def sync_view(model, source, sqlite_path=None, batch_size=1000, engine=None):
+    """Upsert rows of a local SQLite table or view that changed since the last sync into a model's table.
+
+    Each row is sent with a hash of its SQLite values, and only rows whose hash differs
+    from the one stored in the target are sent again. New, backfilled and corrected
+    dates are all synced, and re-running a sync sends nothing.
+
+    Args:
+        model: Declarative model class of the destination table.
+        source: A string containing the name of the SQLite table or view.
+        sqlite_path: A string containing the SQLite database path. Defaults to DB_PATH.
+        batch_size: Number of rows upserted per round trip.
+        engine: SQLAlchemy engine. Defaults to the shared engine for DB_URL.
+
+    Returns:
+        row_count: Integer of rows sent to the target.
+    """
+
+    engine = engine or orm_init()
+    table = model.__table__
+    columns = [col for col in table.columns.keys() if col != 'row_hash']
+
+    Base.metadata.create_all(engine, tables=[table])
+    _add_hash_column(engine, table)
+
+    row_count = 0
+
+    with engine.begin() as con:
+        synced = dict(con.execute(select(table.c.date, table.c.row_hash)).all())
+        rows = (row for row in _sqlite_rows(sqlite_path or os.getenv('DB_PATH'), source, columns, batch_size)
+                if synced.get(row['date']) != row['row_hash'])
+        stmt = upsert_statement(engine, table)
+
+        for batch in iter(lambda: list(itertools.islice(rows, batch_size)), []):
+            con.execute(stmt, batch)
+            row_count += len(batch)
+
+    return row_count
+
+
+def sync_prod(sqlite_path=None, engine=None):
+    """Sync journal_prod and rescuetime_prod from the SQLite views they are built from.
+
+    Args:
+        sqlite_path: A string containing the SQLite database path. Defaults to DB_PATH.
+        engine: SQLAlchemy engine. Defaults to the shared engine for DB_URL.
+
+    Returns:
+        row_counts: Dictionary of table names and the number of rows sent.
+    """
+
+    return {model.__tablename__: sync_view(model, source, sqlite_path, engine=engine)
+            for model, source in [(JournalProd, 'journal_view'), (RescueTimeProd, 'rescuetime_view')]}
+
+
+def load_table(model, source, csv_name, rename=None, sqlite_path=None, engine=None):
+    """Load a model's table straight from the local SQLite database, or from a CSV export without one.
+
+    Args:
+        model: Declarative model class of the destination table.
+        source: A string containing the name of the SQLite table or view.
+        csv_name: A string containing the name of the CSV export in APP_DIR, without extension.
+        rename: Optional dictionary of CSV headers and the columns they are loaded into.
+        sqlite_path: A string containing the SQLite database path. Defaults to DB_PATH.
+        engine: SQLAlchemy engine. Defaults to the shared engine for DB_URL.
+
+    Returns:
+        row_count: Integer of rows loaded.
+    """
+
+    sqlite_path = sqlite_path or os.getenv('DB_PATH')
+
+    if sqlite_path:
+        return sync_view(model, source, sqlite_path, engine=engine)
+
+    return bulk_load_csv(model, f"{DIR}/{csv_name}.csv", rename=rename, engine=engine)
+
+
+def insert_mood_charts(engine=None, sqlite_path=None):
+
+    return load_table(MoodCharts, 'mood_charts', 'mood_charts', sqlite_path=sqlite_path, engine=engine)
+
+
+def insert_bullet_journal(engine=None, sqlite_path=None):
+
+    return load_table(BulletJournal, 'bullet_journal', 'bullet_journal', sqlite_path=sqlite_path, engine=engine)
+
+
+def insert_exist_journal(engine=None, sqlite_path=None):
+
+    return load_table(ExistJournal, 'exist_journal', 'exist_journal', rename={'mood_note': 'entry'}, sqlite_path=sqlite_path, engine=engine)
+
+
+def insert_remarkable(engine=None, sqlite_path=None):
+
+    return load_table(reMarkable, 'remarkable', 'remarkable', sqlite_path=sqlite_path, engine=engine)
+
+
+def insert_journal_prod(engine=None, sqlite_path=None):
+
+    return load_table(JournalProd, 'journal_view', 'journal_prod', sqlite_path=sqlite_path, engine=engine)
+
+
+def insert_rescuetime_prod(engine=None, sqlite_path=None):
 
-    session.commit()
-    session.close()
+    return load_table(RescueTimeProd, 'rescuetime_view', 'rescuetime_prod', sqlite_path=sqlite_path, engine=engine)
 
 
 def etl_init():
-    """Create tables (if they don't already exist)"""
-    db = orm_init()
-    insert_journal_prod(db)
-    insert_rescuetime_prod(db)
+    """Create tables (if they don't already exist) and sync them with the local SQLite views."""
+    sync_prod()
 
 if __name__ == '__main__':
 
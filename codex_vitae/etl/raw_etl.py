@@ -3,74 +3,118 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import re
 from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 import json
 
-import datetime
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
 import sqlite3
 
 import pandas as pd
 
-from sqlite_module import db_create, db_historical, db_prod
-from api_requests import authenticate_gmail_api, get_email_content, get_rescuetime_daily
-from text_processing import reMarkableParsing, fitness_parsing, nutrition_parsing
+from sqlite_module import PROD_TABLES, HISTORICAL_TABLES, db_create, db_upsert, db_materialize, frame_rows, merge_backfill
+from api_requests import authenticate_gmail_api, get_email_content, iter_email_content, get_rescuetime_daily, MessageCache
+from text_processing import reMarkableParsing, mynetdiary_rows, mynetdiary_columns, parallel_parse, ParseCache
 
 
 # Configure Environment Variables.
 DATA_DIR = os.getenv('DATA_DIR')
 CRED = os.getenv('CRED')
 API_KEY = os.getenv('API_KEY')
+# CSV exports are an optional side output, since orm_inserts loads straight from the DB.
+EXPORT_CSV = os.getenv('EXPORT_CSV')
+
+# Exist extract files of daily values, e.g. data_mood_note_2021.json.
+EXIST_FILE_RE = re.compile(r'data_(\w+)_(\d{4})\.json$')
 
     
-def json_to_df(var_list, year):
+def _load_json(path):
+    """Read a json file, with orjson if it is installed."""
+
+    with open(path, 'rb') as f:
+        return _json_loads(f.read())
+
+
+def json_to_df(var_list, year, loads=None, directory='.', cutoff=None):
     """
-    Create a Pandas DF from a list of Exist json files.
+    Create a Pandas DF from a list of Exist json files, aligned on their dates.
 
     Args:
         var_list: A list identifying data variables of interest.
         year: A string specifying the year in the json name.
-    
+        loads: Optional function reading a json file path into a list of date and value records.
+        directory: A string containing the directory of the json files.
+        cutoff: Optional date string. Only records after this date are kept.
+    
     Returns: 
         dataframe: A Pandas Dataframe containing a column for each json. 
     """
 
-    # Write json file names to a list variable. 
-    json_list = os.listdir()
+    loads = loads or _load_json
+
+    columns = []
+
+    for var in var_list:
+        records = loads(os.path.join(directory, f'data_{var}_{year}.json'))
+
+        if cutoff is not None:
+            records = [record for record in records if record['date'] > cutoff]
+
+        columns.append(pd.Series(
+            [record['value'] for record in records],
+            index=pd.Index([record['date'] for record in records], name='date'),
+            name=var.split(".")[0],
+            ))
 
-    # Filter out weekly averages and correlations from file list.
-    json_list = [match for match in json_list if "data" in match]
+    # Align every variable on the union of dates in a single step.
+    dataframe = pd.concat(columns, axis=1, sort=True).reset_index()
 
-    # Filter files by year.
-    json_list = [match for match in json_list if year in match]
+    # Keep the column order of the Exist tables, which lead with the first variable.
+    return dataframe[[columns[0].name, 'date'] + [column.name for column in columns[1:]]]
 
-    for json_list in var_list:
-        json_ = json.load(open(f'data_{json_list}_{year}.json', "r"))
-        df = pd.DataFrame(json_).rename(columns={"value": json_list.split(".")[0]})
 
-        try:
-            dataframe = dataframe.merge(df,on='date',how='outer')
+def exist_years(directory, cutoff=None):
+    """
+    List the years of data in an Exist extract from its json file names.
+
+    Args:
+        directory: A string containing the directory of the json files.
+        cutoff: Optional date string. Years ending before this date are left out.
+    
+    Returns: 
+        year_list: A sorted list of year strings.
+    """
 
-        except UnboundLocalError:
-            dataframe = pd.DataFrame(df).rename(columns={"value": json_list.split(".")[0]})
+    years = {match.group(2) for match in map(EXIST_FILE_RE.match, os.listdir(directory)) if match}
 
-    return dataframe
+    return sorted(year for year in years if cutoff is None or f'{year}-12-31' > cutoff)
 
 
-def exist_dataframes(filepath):
+def exist_dataframes(filepath, cutoff='2020-04-06', max_workers=None):
     """
     Creates a list of Pandas dataframes containing all Exist data.
 
+    Every year found in the extract is read, in parallel threads.
+
     Args:
         filepath: A string containing the filepath to the Exist data extract.
-    
+        cutoff: Optional date string. Only data after this date is read.
+        max_workers: Maximum number of threads reading json files.
+    
     Returns: 
         df_list: A list of Pandas Dataframes containing all Exist data. 
     """
     
-    filepath = os.chdir(f'{filepath}/exist_full_extract')
+    directory = os.path.abspath(os.path.join(filepath, 'exist_full_extract'))
 
-    # Specify years of data to retrieve as a list.
-    year_list = ['2020', '2021']
+    # Retrieve every year of data in the extract.
+    year_list = exist_years(directory, cutoff)
 
     # Lists of desired datafields from Exist.
     # Each list will be inserted into its own database table.
@@ -117,14 +161,12 @@ def exist_dataframes(filepath):
     # Create a master list of the above lists
     json_lists = [tags, journal, productivity, fitness]
 
-    # Loop through the above list, naming the dataframes after their respective json lists and saving to a another list
-    df_list = []
+    # Read every list and year concurrently, then stack the years of each list in order.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [[executor.submit(json_to_df, jsons, year, directory=directory, cutoff=cutoff) for year in year_list]
+                   for jsons in json_lists]
 
-    for jsons in json_lists:
-        df_years = [json_to_df(jsons,year) for year in year_list]
-        df = pd.concat(df_years,axis=0)
-        df = df[df['date'] > '2020-04-06']
-        df_list.append(df)
+        df_list = [pd.concat([future.result() for future in df_years], axis=0) for df_years in futures]
     
     return df_list
 
@@ -134,15 +176,12 @@ def to_tuple_gen(df):
 
     Args:
         df: The pandas dataframe to be converted
-    
+    
     Returns: 
-        tuple_list: A list of tuples.
+        tuple_gen: A generator of row tuples, with missing values as None.
     """
     
-    tuple_gen = list(df.itertuples(index=False,name=None))
-
-    for tuple_ in tuple_gen:
-        yield (tuple_,)
+    return frame_rows(df)
 
 if __name__ == '__main__':
 
@@ -151,58 +190,50 @@ if __name__ == '__main__':
     # Change directory to where files will be written.
     os.chdir(DATA_DIR)
 
-    # Convert dataframes into CSVs and tuple lists.
+    # Dataframes are streamed into the DB without building tuple lists.
     _exist_rescuetime = _df_list[2].dropna()
-    _exist_rescuetime.to_csv('exist_rescuetime.csv',index=False)
-    _exist_rescuetime = list(_exist_rescuetime.itertuples(index=False,name=None))
+    _exist_garmin = _df_list[3]
 
-    _df_list[3].to_csv('exist_garmin.csv',index=False)
-    _exist_garmin = list(_df_list[3].itertuples(index=False,name=None))
-
-    # Remove in nulls in Exist Journal DF before converting to CSV and tuple list.
+    # Remove in nulls in Exist Journal DF.
     _exist_journal = _df_list[1].dropna()
-    _exist_journal.to_csv('exist_journal.csv',index=False)
-    _exist_journal = list(_exist_journal.itertuples(index=False,name=None))
 
-    # Fill in nulls in Exist Tags DF before converting to CSV and tuple list.
+    # Fill in nulls in Exist Tags DF.
     _exist_tags = _df_list[0].fillna(0)
-    _exist_tags.to_csv('exist_tags.csv',index=False)
-    _exist_tags = list(_exist_tags.itertuples(index=False,name=None))
 
-    # Load CSVs, fill in nulls, and convert intointo tuple generators.
+    # Load CSVs and fill in nulls.
     _mood_charts = pd.read_csv('mood_charts.csv')
     _mood_charts = _mood_charts.fillna(0)
-    _mood_charts.to_csv('mood_charts.csv',index=False)
-    _mood_charts = list(_mood_charts.itertuples(index=False,name=None))
     
     _bullet_journal = pd.read_csv('bullet_journal.csv')
     _bullet_journal = _bullet_journal.fillna(0)
-    _bullet_journal.to_csv('bullet_journal.csv',index=False)
-    _bullet_journal = list(_bullet_journal.itertuples(index=False,name=None))
+
+    # Optionally write the cleaned dataframes to CSVs.
+    if EXPORT_CSV:
+        for _name, _df in [('exist_rescuetime', _exist_rescuetime),
+                           ('exist_garmin', _exist_garmin),
+                           ('exist_journal', _exist_journal),
+                           ('exist_tags', _exist_tags),
+                           ('mood_charts', _mood_charts),
+                           ('bullet_journal', _bullet_journal),
+                           ]:
+            _df.to_csv(f'{_name}.csv',index=False)
+
+    # Create or upgrade the DB, which also holds the caches of downloaded and parsed emails.
+    db = f'{DATA_DIR}/db'
+    db_create(db)
+    _cache = MessageCache(db)
+    _parse_cache = ParseCache(db)
 
     # Perform API calls for production data.
-    # GMail API calls only return 100 results, so multiple calls must be made and appended together
-    date1_ = str(datetime.date(2021, 5, 1))
-    date2_ = str(datetime.date(2021, 7, 18))
-    date3_ = str(datetime.date(2021, 10, 25))
-    date4_ = str(datetime.date(2022, 1, 18))
-    
+    # reMarkable emails are parsed in worker processes as they stream in, one chunk at a time.
     with closing(authenticate_gmail_api(CRED)) as service:
-        _remarkable = get_email_content(service,query=f"from:my@remarkable.com,before:{date1_}")
-        _remarkable1 = get_email_content(service,query=f"from:my@remarkable.com,after:{date1_},before:{date2_}")
-        _remarkable2 = get_email_content(service,query=f"from:my@remarkable.com,after:{date2_},before:{date3_}")
-        _remarkable3 = get_email_content(service,query=f"from:my@remarkable.com,after:{date3_},before:{date4_}")
-        _remarkable.extend(_remarkable1)
-        _remarkable.extend(_remarkable2)
-        _remarkable.extend(_remarkable3)
-        _mynetdiary = get_email_content(service,query=f"from:no-reply@mynetdiary.net")
+        _remarkable = parallel_parse(reMarkableParsing().run, iter_email_content(service,query="from:my@remarkable.com",cache=_cache))
+        _mynetdiary = get_email_content(service,query=f"from:no-reply@mynetdiary.net",cache=_cache)
     
     _rescuetime = get_rescuetime_daily(API_KEY)
 
-    # Convert reMarkable and MyNetDiary data into tuple generators.
-    _remarkable = reMarkableParsing().run(_remarkable)
-    _fitness = fitness_parsing(_mynetdiary)
-    _nutrition = nutrition_parsing(_mynetdiary)
+    # Convert MyNetDiary data into lists of tuples, scanning each email once and only if not parsed before.
+    _fitness, _nutrition = _parse_cache.parse('mynetdiary', mynetdiary_rows, _mynetdiary, assemble=mynetdiary_columns)
 
     _hist_list = [_exist_tags,
                  _exist_journal,
@@ -218,72 +249,53 @@ if __name__ == '__main__':
                  _nutrition,
                 ]
 
-    # Create DB and perform insertions.
-    db = f'{DATA_DIR}/db'
-    db_create(db)
-    db_prod(db, _prod_list)
-    db_historical(db, _hist_list)
-
     os.chdir(DATA_DIR)
 
-    # Update entries.
-    con = sqlite3.connect(db)
-    cur = con.cursor()
-
-    rsctm_update = """
-            INSERT INTO rescuetime
-            (date, prd_hours, dst_hours, neut_hours)
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(date) DO UPDATE SET date = excluded.date
-            """
-
-    jrnl_update = """
-            UPDATE remarkable
-                SET mood = ? ,
-                    entry = ?
-                WHERE date = ?
-            """
-
-    fitness_update = """
-            UPDATE fitness
-                SET pulse = ? ,
-                    sleep = ? ,
-                    deep_sleep = ? ,
-                    light_sleep = ? ,
-                    rem_sleep = ? ,
-                    awakes = ? ,
-                    daily_steps = ?,
-                    calories_out = ?
-                WHERE date = ?
-            """
-
-    # Read backfill files for RescueTime, Journal, and Fitness
-    updt_rsctm = [(day,p,d,n) for (day,p,d,n) in json.load(open('rt_backfill.json', 'r'))]
-    updte_jrnl = [(mood,entry,day) for (mood,entry,day) in json.load(open('journal_backfill.json', 'r'))]
-    updt_ftnss = [(p,s,ds,ls,rs,a,ds,c,day) for (p,s,ds,ls,rs,a,ds,c,day) in json.load(open('fitness_backfill.json', 'r'))]
-
-    cur.executemany(rsctm_update,updt_rsctm)
-    cur.executemany(jrnl_update,updte_jrnl)
-    cur.executemany(fitness_update,updt_ftnss)
-
-    # Convert production tables to CSVs
-    _rescuetime = pd.read_sql('select * from rescuetime order by date', con)
-    _rescuetime.to_csv('rescuetime.csv',index=False)
-
-    _remarkable = pd.read_sql('select * from remarkable order by date', con)
-    _remarkable.to_csv('remarkable.csv',index=False)
-
-    _fitness = pd.read_sql('select * from fitness order by date', con)
-    _fitness.to_csv('fitness.csv',index=False)
-
-    _nutrition = pd.read_sql('select * from nutrition order by date', con)
-    _nutrition.to_csv('nutrition.csv',index=False)
-
-    _journal_prod = pd.read_sql('select * from journal_view order by date', con)
-    _journal_prod.to_csv('journal_prod.csv',index=False)
-
-    _rescuetime_prod = pd.read_sql('select * from rescuetime_view order by date', con)
-    _rescuetime_prod.to_csv('rescuetime_prod.csv',index=False)
-
-    con.commit()
-    con.close()
+    # Backfill files for RescueTime, Journal, and Fitness are merged into the production rows,
+    # so each date is written once. Journal and Fitness backfills replace the columns they
+    # contain, while RescueTime API data wins over its backfill.
+    _backfills = [('rescuetime', ['date', 'prd_hours', 'dst_hours', 'neut_hours'], 'rt_backfill.json', True),
+                  ('remarkable', ['mood', 'entry', 'date'], 'journal_backfill.json', False),
+                  ('fitness', ['pulse', 'sleep', 'deep_sleep', 'light_sleep', 'rem_sleep',
+                               'awakes', 'daily_steps', 'calories_out', 'date'], 'fitness_backfill.json', False),
+                  ]
+
+    _prod_tables = [table for table, _ in PROD_TABLES]
+    _backfill_tables, _backfill_list = [], []
+
+    for _table, _columns, _path, _keep_existing in _backfills:
+        with open(_path, 'r') as f:
+            _backfill = json.load(f)
+
+        _i = _prod_tables.index(_table)
+        _prod_list[_i], _leftover = merge_backfill(PROD_TABLES[_i][1], _prod_list[_i], _columns, _backfill,
+                                                   keep_existing=_keep_existing)
+
+        # Backfilled dates without production rows this run; RescueTime only fills missing dates.
+        _backfill_tables.append((_table, _columns, _keep_existing))
+        _backfill_list.append(_leftover)
+
+    # Upsert all data and leftover backfills in a single pass.
+    db_upsert(db,
+              PROD_TABLES + HISTORICAL_TABLES + _backfill_tables,
+              _prod_list + _hist_list + _backfill_list)
+
+    # Optionally convert production tables and views to CSVs. orm_inserts reads the DB directly.
+    if EXPORT_CSV:
+        con = sqlite3.connect(db)
+
+        for _table, _columns in PROD_TABLES:
+            _df = pd.read_sql(f'select {", ".join(_columns)} from {_table} order by date', con)
+            _df.to_csv(f'{_table}.csv',index=False)
+
+        _journal_prod = pd.read_sql('select * from journal_view order by date', con)
+        _journal_prod.to_csv('journal_prod.csv',index=False)
+
+        _rescuetime_prod = pd.read_sql('select * from rescuetime_view order by date', con)
+        _rescuetime_prod.to_csv('rescuetime_prod.csv',index=False)
+
+        con.close()
+
+    # Optionally store the views as date-indexed tables, refreshed after each load.
+    if os.getenv('MATERIALIZE_VIEWS'):
+        db_materialize(db, triggers=False)
@@ -3,184 +3,702 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+import functools
 from contextlib import closing
 import sqlite3
 
-def db_create(db_path):
-    """Create all SQLite database tables and views.
+
+logger = logging.getLogger(__name__)
+
+# PRAGMAs applied to loading connections. WAL with synchronous=NORMAL only
+# syncs the write-ahead log at checkpoints instead of on every commit.
+LOAD_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -64000,  # Negative values are in KiB, i.e. 64 MB.
+    'temp_store': 'MEMORY',
+}
+
+_INSERT_RE = re.compile(r'INSERT\s+INTO\s+(\w+)', re.IGNORECASE)
+
+
+# Columns, source tables and queries behind the views. In materialized mode
+# each view is replaced by a date-indexed table of the same name holding the
+# query results, so readers do not need to change.
+# Sources are listed in order of precedence: on a date covered by several
+# sources, the row from the last one listed is kept. Each source SELECT ends in
+# a {where} placeholder, so refreshes of one date can use the date primary keys.
+VIEWS = {
+    'journal_view': {
+        'columns': [('date', 'text'), ('mood', 'float'), ('entry', 'text')],
+        'sources': ['mood_charts', 'bullet_journal', 'exist_journal', 'remarkable'],
+        'select': """
+            SELECT date, mood, mood_note FROM (
+                SELECT date, mood, mood_note, max(source) FROM (
+                    SELECT date, (mood-4)/3 as mood, mood_note, 1 as source FROM mood_charts{where}
+                    UNION ALL
+                    SELECT date, (mood-3)/2 as mood, mood_note, 2 as source FROM bullet_journal{where}
+                    UNION ALL
+                    SELECT date, (mood-5)/4 as mood, entry, 3 as source FROM exist_journal{where}
+                    UNION ALL
+                    SELECT date, (mood-5)/4 as mood, entry, 4 as source FROM remarkable{where}
+                    )
+                GROUP BY date
+                )
+            """,
+    },
+    'rescuetime_view': {
+        'columns': [('date', 'text'), ('prd_hours', 'float'), ('dst_hours', 'float'), ('neut_hours', 'float')],
+        'sources': ['exist_time', 'rescuetime'],
+        'select': """
+            SELECT date, prd_hours, dst_hours, neut_hours FROM (
+                SELECT date, prd_hours, dst_hours, neut_hours, max(source) FROM (
+                    SELECT
+                    date, 
+                    prd_mins/60 as prd_hours,
+                    dst_mins/60 as dst_hours,
+                    neut_mins/60 as neut_hours,
+                    1 as source
+                    FROM exist_time{where}
+                    UNION ALL
+                    SELECT date, prd_hours, dst_hours, neut_hours, 2 as source FROM rescuetime{where}
+                    )
+                GROUP BY date
+                )
+            """,
+    },
+}
+
+
+# Registry of every table. Columns are (name, declaration) pairs in the order data
+# tuples are supplied, and drive the DDL, the upsert statements and the ORM models.
+# Every table also has a row_hash column, which is internal to SQLite.
+TABLES = {
+    # Historical tables.
+    'exist_tags': [
+        ('alcohol', 'integer'),
+        ('date', 'text PRIMARY KEY'),
+        ('bedsheets', 'integer'),
+        ('cardio', 'integer'),
+        ('cleaning', 'integer'),
+        ('dating', 'integer'),
+        ('drawing', 'integer'),
+        ('eating_out', 'integer'),
+        ('fasting', 'integer'),
+        ('guitar', 'integer'),
+        ('laundry', 'integer'),
+        ('learning', 'integer'),
+        ('meal_prep', 'integer'),
+        ('meditation', 'integer'),
+        ('nap', 'integer'),
+        ('nutribullet', 'integer'),
+        ('piano', 'integer'),
+        ('reading', 'integer'),
+        ('shopping', 'integer'),
+        ('tech', 'integer'),
+        ('travel', 'integer'),
+        ('tv', 'integer'),
+        ('walk', 'integer'),
+        ('writing', 'integer'),
+    ],
+    'exist_journal': [
+        ('mood', 'float'),
+        ('date', 'text PRIMARY KEY'),
+        ('entry', 'text'),
+    ],
+    'exist_time': [
+        ('prd_mins', 'float'),
+        ('date', 'text PRIMARY KEY'),
+        ('dst_mins', 'float'),
+        ('neut_mins', 'float'),
+    ],
+    'exist_fitness': [
+        ('active_cal', 'float'),
+        ('date', 'text PRIMARY KEY'),
+        ('pulse', 'integer'),
+        ('pulse_max', 'integer'),
+        ('pulse_rest', 'integer'),
+        ('steps', 'integer'),
+        ('weight', 'float'),
+        ('sleep', 'float'),
+        ('sleep_end', 'float'),
+        ('sleep_start', 'float'),
+    ],
+    'mood_charts': [
+        ('date', 'text PRIMARY KEY'),
+        ('mood', 'float'),
+        ('sleep', 'integer'),
+        ('cardio', 'integer'),
+        ('meditate', 'integer'),
+        ('mood_note', 'text'),
+    ],
+    'bullet_journal': [
+        ('date', 'text PRIMARY KEY'),
+        ('mood', 'float'),
+        ('sleep', 'integer'),
+        ('steps', 'integer'),
+        ('cardio', 'integer'),
+        ('meditate', 'integer'),
+        ('mood_note', 'text'),
+        ('fasting', 'integer'),
+        ('cheat_meals', 'integer'),
+        ('read', 'integer'),
+        ('draw', 'integer'),
+        ('learn', 'integer'),
+        ('write', 'integer'),
+        ('guitar', 'integer'),
+    ],
+    # Production tables.
+    'rescuetime': [
+        ('date', 'text PRIMARY KEY'),
+        ('prd_hours', 'float NOT NULL'),
+        ('dst_hours', 'float NOT NULL'),
+        ('neut_hours', 'float NOT NULL'),
+    ],
+    'remarkable': [
+        ('date', 'text PRIMARY KEY'),
+        ('mood', 'float NOT NULL'),
+        ('entry', 'text NOT NULL'),
+    ],
+    'fitness': [
+        ('date', 'text PRIMARY KEY'),
+        ('weight', 'float'),
+        ('bmr', 'float'),
+        ('pulse', 'integer'),
+        ('sleep', 'float'),
+        ('deep_sleep', 'float'),
+        ('light_sleep', 'float'),
+        ('rem_sleep', 'float'),
+        ('awakes', 'float'),
+        ('daily_steps', 'integer'),
+        ('calories_out', 'integer'),
+    ],
+    'nutrition': [
+        ('date', 'text PRIMARY KEY'),
+        ('calories', 'integer'),
+        ('total_fat', 'integer'),
+        ('total_carbs', 'integer'),
+        ('protein', 'integer'),
+        ('sat_fat', 'integer'),
+        ('sodium', 'integer'),
+        ('net_carbs', 'integer'),
+    ],
+}
+
+# Tables loaded by db_historical and db_prod, with the columns supplied for each.
+HISTORICAL_TABLES = [(table, [col for col, _ in TABLES[table]]) for table in [
+    'exist_tags',
+    'exist_journal',
+    'exist_time',
+    'exist_fitness',
+    'mood_charts',
+    'bullet_journal',
+    ]]
+
+PROD_TABLES = [(table, [col for col, _ in TABLES[table]]) for table in [
+    'rescuetime',
+    'remarkable',
+    'fitness',
+    'nutrition',
+    ]]
+
+
+def table_ddl(table):
+    """Build the CREATE TABLE statement for a table in the registry.
+
+    Args:
+        table: String containing the table name.
+
+    Returns:
+        sql: String containing the SQL DDL statement.
+    """
+
+    columns = ",\n            ".join(f"{col} {decl}" for col, decl in TABLES[table] + [('row_hash', 'text')])
+
+    return f"""
+        CREATE TABLE IF NOT EXISTS {table}(
+            {columns}
+        )
+        """
+
+
+def _drop_view(con, view):
+    """Drop a view, or its materialized table if the view is materialized."""
+
+    kind = con.execute("SELECT type FROM sqlite_master WHERE name = ?", (view,)).fetchone()
+
+    if kind is not None:
+        con.execute(f"DROP {kind[0].upper()} {view}")
+
+
+def _materialized_views(con):
+    """List materialized views that are not kept current by triggers."""
+
+    tables = con.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ({})".format(
+            ", ".join("?" * len(VIEWS))),
+        list(VIEWS),
+        ).fetchall()
+
+    return [name for (name,) in tables
+            if con.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name GLOB ?",
+                (f"{name}_*",),
+                ).fetchone() is None]
+
+
+def _refresh_view(view, key=None):
+    """Build the statements that recompute a materialized view in full or for one date."""
+
+    where = "" if key is None else f" WHERE date = {key}"
+
+    return [f"DELETE FROM {view}{where}",
+            f"INSERT INTO {view} {VIEWS[view]['select'].format(where=where)}",
+            ]
+
+
+def _view_mode(con):
+    """Return whether the views are materialized and whether triggers maintain them."""
+
+    kind = con.execute("SELECT type FROM sqlite_master WHERE name = 'journal_view'").fetchone()
+    trigger = con.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name GLOB 'journal_view_*'"
+        ).fetchone()
+
+    return kind is not None and kind[0] == 'table', trigger is not None
+
+
+def _drop_views(con):
+    """Drop all views or materialized views, along with their triggers."""
+
+    for view, spec in VIEWS.items():
+        _drop_view(con, view)
+
+        for source in spec['sources']:
+            for event in ('insert', 'update', 'delete'):
+                con.execute(f"DROP TRIGGER IF EXISTS {view}_{source}_{event}")
+
+
+def _build_views(con, materialize=False, triggers=False):
+    """Recreate all views as plain views or as materialized tables."""
+
+    _drop_views(con)
+
+    for view, spec in VIEWS.items():
+        if not materialize:
+            con.execute(f"""
+                CREATE VIEW {view}({", ".join(col for col, _ in spec['columns'])})
+                AS {spec['select'].format(where="")}
+                """)
+            continue
+
+        con.execute(f"""
+            CREATE TABLE {view}({", ".join(f"{col} {type_}" for col, type_ in spec['columns'])})
+            """)
+        con.execute(f"CREATE INDEX {view}_date ON {view}(date)")
+
+        for statement in _refresh_view(view):
+            con.execute(statement)
+
+        if not triggers:
+            continue
+
+        refresh = {
+            'insert': _refresh_view(view, 'NEW.date'),
+            'update': _refresh_view(view, 'OLD.date') + _refresh_view(view, 'NEW.date'),
+            'delete': _refresh_view(view, 'OLD.date'),
+        }
+
+        for source in spec['sources']:
+            # Filling in row hashes after a load does not change what the view shows.
+            columns = ", ".join(col for col, _ in TABLES[source])
+            events = {'insert': 'INSERT', 'update': f"UPDATE OF {columns}", 'delete': 'DELETE'}
+
+            for event, statements in refresh.items():
+                con.execute(f"""
+                    CREATE TRIGGER {view}_{source}_{event}
+                    AFTER {events[event]} ON {source}
+                    BEGIN
+                        {"; ".join(statements)};
+                    END
+                    """)
+
+
+def _add_row_hash(con):
+    """Add a content hash column to every table so unchanged rows can skip upserts."""
+
+    materialize, triggers = _view_mode(con)
+    _drop_views(con)
+
+    for table in ['exist_tags', 'exist_journal', 'exist_time', 'exist_fitness', 'mood_charts',
+                  'bullet_journal', 'rescuetime', 'remarkable', 'fitness', 'nutrition']:
+        con.execute(f"ALTER TABLE {table} ADD COLUMN row_hash text")
+
+    # rescuetime_view no longer selects * from rescuetime, which now has an extra column.
+    _build_views(con, materialize, triggers)
+
+
+def _rebuild_views(con):
+    """Recreate the views from the registry, keeping them plain or materialized as they were."""
+
+    _build_views(con, *_view_mode(con))
+
+
+# Ordered schema migrations. Step n upgrades a DB from user_version n-1 to n and
+# is either a SQL script or a function taking the connection.
+# Released steps must never be edited; append a new step to change the schema.
+MIGRATIONS = [
+    # 1: Initial tables and views.
+    """
+    CREATE TABLE IF NOT EXISTS rescuetime(
+        date text PRIMARY KEY,
+        prd_hours float NOT NULL,
+        dst_hours float NOT NULL,
+        neut_hours float NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS remarkable(
+        date text PRIMARY KEY,
+        mood float NOT NULL,
+        entry text NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS fitness(
+        date text PRIMARY KEY,
+        weight float,
+        bmr float,
+        pulse integer,
+        sleep float,
+        deep_sleep float,
+        light_sleep float,
+        rem_sleep float,
+        awakes float,
+        daily_steps integer,
+        calories_out integer
+    );
+
+    CREATE TABLE IF NOT EXISTS nutrition(
+        date text PRIMARY KEY,
+        calories integer,
+        total_fat integer,
+        total_carbs integer,
+        protein integer,
+        sat_fat integer,
+        sodium integer,
+        net_carbs integer
+    );
+
+    CREATE TABLE IF NOT EXISTS exist_tags(
+        alcohol integer,
+        date text PRIMARY KEY,
+        bedsheets integer,
+        cardio integer,
+        cleaning integer,
+        dating integer,
+        drawing integer,
+        eating_out integer,
+        fasting integer,
+        guitar integer,
+        laundry integer,
+        learning integer,
+        meal_prep integer,
+        meditation integer,
+        nap integer,
+        nutribullet integer,
+        piano integer,
+        reading integer,
+        shopping integer,
+        tech integer,
+        travel integer,
+        tv integer,
+        walk integer,
+        writing integer
+    );
+
+    CREATE TABLE IF NOT EXISTS exist_journal(
+        mood float,
+        date text PRIMARY KEY,
+        entry text
+    );
+
+    CREATE TABLE IF NOT EXISTS exist_time(
+        prd_mins float,
+        date text PRIMARY KEY,
+        dst_mins float,
+        neut_mins float
+    );
+
+    CREATE TABLE IF NOT EXISTS exist_fitness(
+        active_cal float,
+        date text PRIMARY KEY,
+        pulse integer,
+        pulse_max integer,
+        pulse_rest integer,
+        steps integer,
+        weight float,
+        sleep float,
+        sleep_end float,
+        sleep_start float
+    );
+
+    CREATE TABLE IF NOT EXISTS mood_charts(
+        date text PRIMARY KEY,
+        mood float,
+        sleep integer,
+        cardio integer,
+        meditate integer,
+        mood_note text
+    );
+
+    CREATE TABLE IF NOT EXISTS bullet_journal(
+        date text PRIMARY KEY,
+        mood float,
+        sleep integer,
+        steps integer,
+        cardio integer,
+        meditate integer,
+        mood_note text,
+        fasting integer,
+        cheat_meals integer,
+        read integer,
+        draw integer,
+        learn integer,
+        write integer,
+        guitar integer
+    );
+
+    CREATE VIEW IF NOT EXISTS journal_view(date, mood, entry)
+    AS
+        SELECT date, (mood-4)/3 as mood, mood_note FROM mood_charts
+        UNION
+        SELECT date, (mood-3)/2 as mood, mood_note FROM bullet_journal
+        UNION
+        SELECT date, (mood-5)/4 as mood, entry FROM exist_journal
+        UNION
+        SELECT date, (mood-5)/4 as mood, entry FROM remarkable
+    ;
+
+    CREATE VIEW IF NOT EXISTS rescuetime_view(date, prd_hours, dst_hours, neut_hours)
+    AS
+        SELECT
+        date, 
+        prd_mins/60 as prd_hours,
+        dst_mins/60 as dst_hours,
+        neut_mins/60 as neut_hours
+        FROM exist_time
+        UNION
+        SELECT * FROM rescuetime
+    ;
+    """,
+    # 2: Content hash column for upserts.
+    _add_row_hash,
+    # 3: One view row per date, chosen by source precedence.
+    _rebuild_views,
+    # 4: Triggers refresh only the date they touch, and ignore row hash updates.
+    _rebuild_views,
+]
+
+
+def db_migrate(db_path):
+    """Apply any schema migrations the database has not seen yet.
+
+    The schema version is stored in the database header as PRAGMA user_version,
+    so only the missing steps run and existing data is left in place.
 
     Args:
         db_path: A string containing the full directory and database name.
+
+    Returns:
+        version: An integer of the schema version after migrating.
+    """
+
+    with closing(sqlite3.connect(db_path)) as con:
+        version = con.execute('PRAGMA user_version').fetchone()[0]
+
+        # An empty database is created directly at the latest schema from the registry.
+        if version == 0 and con.execute("SELECT count(*) FROM sqlite_master").fetchone()[0] == 0:
+            with con:
+                con.execute("BEGIN")
+
+                for table in TABLES:
+                    con.execute(table_ddl(table))
+
+                _build_views(con)
+                version = len(MIGRATIONS)
+                con.execute(f"PRAGMA user_version = {version}")
+
+            logger.info("Created database at schema version %d", version)
+
+        for version, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            # Each step and its version bump commit together or not at all.
+            if callable(migration):
+                with con:
+                    con.execute("BEGIN")
+                    migration(con)
+                    con.execute(f"PRAGMA user_version = {version}")
+            else:
+                con.executescript(f"""
+                    BEGIN;
+                    {migration}
+                    PRAGMA user_version = {version};
+                    COMMIT;
+                    """)
+            logger.info("Migrated database to schema version %d", version)
+
+    return version
+
+
+def db_create(db_path, rebuild=False):
+    """Create or upgrade all SQLite database tables and views.
+
+    Args:
+        db_path: A string containing the full directory and database name.
+        rebuild: If True, drop all tables and views before recreating them.
     
     Returns:
         db_ver: A string containing the SQLite3 version.    
     """
 
-    con = sqlite3.connect(db_path)
+    if rebuild:
+        with closing(sqlite3.connect(db_path)) as con:
+            _drop_views(con)
+
+            for table in TABLES:
+                con.execute(f"DROP TABLE IF EXISTS {table}")
+
+            con.execute("PRAGMA user_version = 0")
+
+    db_migrate(db_path)
+
+    with closing(sqlite3.connect(db_path)) as con:
+        ver = con.execute('SELECT SQLITE_VERSION()').fetchone()
 
-    con.executescript("""
-        DROP TABLE IF EXISTS rescuetime;
-        DROP TABLE IF EXISTS remarkable;
-        DROP TABLE IF EXISTS fitness;
-        DROP TABLE IF EXISTS nutrition;
-        DROP TABLE IF EXISTS exist_tags;
-        DROP TABLE IF EXISTS exist_journal;
-        DROP TABLE IF EXISTS exist_time;
-        DROP TABLE IF EXISTS exist_fitness;
-        DROP TABLE IF EXISTS mood_charts;
-        DROP TABLE IF EXISTS bullet_journal;
-        DROP VIEW IF EXISTS journal_view;
-        DROP VIEW IF EXISTS rescuetime_view;
-
-        CREATE TABLE rescuetime(
-            date text PRIMARY KEY,
-            prd_hours float NOT NULL,
-            dst_hours float NOT NULL,
-            neut_hours float NOT NULL
-        );
-
-        CREATE TABLE remarkable(
-            date text PRIMARY KEY,
-            mood float NOT NULL,
-            entry text NOT NULL
-        );
-
-        CREATE TABLE fitness(
-            date text PRIMARY KEY,
-            weight float,
-            bmr float,
-            pulse integer,
-            sleep float,
-            deep_sleep float,
-            light_sleep float,
-            rem_sleep float,
-            awakes float,
-            daily_steps integer,
-            calories_out integer
-        );
-
-        CREATE TABLE nutrition(
-            date text PRIMARY KEY,
-            calories integer,
-            total_fat integer,
-            total_carbs integer,
-            protein integer,
-            sat_fat integer,
-            sodium integer,
-            net_carbs integer
-        );
-
-        CREATE TABLE exist_tags(
-            alcohol integer,
-            date text PRIMARY KEY,
-            bedsheets integer,
-            cardio integer,
-            cleaning integer,
-            dating integer,
-            drawing integer,
-            eating_out integer,
-            fasting integer,
-            guitar integer,
-            laundry integer,
-            learning integer,
-            meal_prep integer,
-            meditation integer,
-            nap integer,
-            nutribullet integer,
-            piano integer,
-            reading integer,
-            shopping integer,
-            tech integer,
-            travel integer,
-            tv integer,
-            walk integer,
-            writing integer
-        );
-
-        CREATE TABLE exist_journal(
-            mood float,
-            date text PRIMARY KEY,
-            entry text
-        );
-
-        CREATE TABLE exist_time(
-            prd_mins float,
-            date text PRIMARY KEY,
-            dst_mins float,
-            neut_mins float
-        );
-
-        CREATE TABLE exist_fitness(
-            active_cal float,
-            date text PRIMARY KEY,
-            pulse integer,
-            pulse_max integer,
-            pulse_rest integer,
-            steps integer,
-            weight float,
-            sleep float,
-            sleep_end float,
-            sleep_start float
-        );
-
-        CREATE TABLE mood_charts(
-            date text PRIMARY KEY,
-            mood float,
-            sleep integer,
-            cardio integer,
-            meditate integer,
-            mood_note text
-        );
-
-        CREATE TABLE bullet_journal(
-            date text PRIMARY KEY,
-            mood float,
-            sleep integer,
-            steps integer,
-            cardio integer,
-            meditate integer,
-            mood_note text,
-            fasting integer,
-            cheat_meals integer,
-            read integer,
-            draw integer,
-            learn integer,
-            write integer,
-            guitar integer
-        );
-
-        CREATE VIEW journal_view(date, mood, entry)
-        AS
-            SELECT date, (mood-4)/3 as mood, mood_note FROM mood_charts
-            UNION
-            SELECT date, (mood-3)/2 as mood, mood_note FROM bullet_journal
-            UNION
-            SELECT date, (mood-5)/4 as mood, entry FROM exist_journal
-            UNION
-            SELECT date, (mood-5)/4 as mood, entry FROM remarkable
-        ;
-
-        CREATE VIEW rescuetime_view(date, prd_hours, dst_hours, neut_hours)
-        AS
-            SELECT
-            date, 
-            prd_mins/60 as prd_hours,
-            dst_mins/60 as dst_hours,
-            neut_mins/60 as neut_hours
-            FROM exist_time
-            UNION
-            SELECT * FROM rescuetime
-        ;
-
-        """)
-
-    ver = con.execute('SELECT SQLITE_VERSION()').fetchone()
     db_ver = f"SQLite version: {ver}"
-    con.close()
 
     return db_ver
 
 
+def db_materialize(db_path, materialize=True, triggers=True):
+    """Store journal_view and rescuetime_view as date-indexed tables, or revert to plain views.
+
+    Materialized views are refreshed either by triggers on their source tables, which
+    recompute only the dates touched by each write, or in full at the end of every
+    db_bulk_insert load when triggers is False.
+
+    Args:
+        db_path: A string containing the full directory and database name.
+        materialize: If False, replace the tables with plain views again.
+        triggers: If True, keep the tables current with triggers on the source tables.
+    """
+
+    with closing(sqlite3.connect(db_path)) as con:
+        with con:
+            # DDL does not open a transaction implicitly, so start one explicitly.
+            con.execute("BEGIN")
+
+            _build_views(con, materialize, triggers)
+
+
+def db_connect(db_path, pragmas=LOAD_PRAGMAS):
+    """Open a SQLite connection configured for bulk loading, with the hash_row SQL function used by upserts.
+
+    Args:
+        db_path: String containing the full directory and database name.
+        pragmas: Dictionary of PRAGMA names and values to set on the connection.
+
+    Returns:
+        con: SQLite connection object.
+    """
+
+    con = sqlite3.connect(db_path)
+    con.create_function('hash_row', -1, _row_hash, deterministic=True)
+
+    for pragma, value in pragmas.items():
+        con.execute(f"PRAGMA {pragma} = {value}")
+
+    return con
+
+
+def frame_rows(df, batch_size=10000):
+    """Stream the rows of a Pandas DataFrame as tuples for executemany, in batches.
+
+    Each column is converted to Python objects once, with missing values replaced by
+    None in bulk, and only one batch of row tuples exists at a time.
+
+    Args:
+        df: Pandas DataFrame with columns in insertion order.
+        batch_size: Number of rows converted at a time.
+
+    Yields:
+        row: A tuple of values for each row, with NULLs as None.
+    """
+
+    import pandas as pd
+
+    for start in range(0, len(df), batch_size):
+        columns = []
+
+        for _, series in df.iloc[start:start + batch_size].items():
+            values = series.to_numpy(dtype=object)
+            values[pd.isna(values)] = None
+            columns.append(values.tolist())
+
+        yield from zip(*columns)
+
+
+def _as_rows(data):
+    """Return rows of a DataFrame through frame_rows, and any other iterable of rows as is."""
+
+    if hasattr(data, 'columns') and hasattr(data, 'to_numpy'):
+        return frame_rows(data)
+
+    return data
+
+
+def db_bulk_insert(db_path, sql_list, gen_list):
+    """Insert data into several DB tables over one connection in one transaction.
+
+    Args:
+        db_path: String containing the full directory and database name.
+        sql_list: List of strings containing SQL insertion statements.
+        gen_list: List of generator objects containing date tuples, or DataFrames,
+            to be inserted in the same order as sql_list.
+
+    Returns:
+        row_counts: Dictionary of table names and the number of rows written.
+    """
+
+    row_counts = {}
+
+    with closing(db_connect(db_path)) as con:
+        # All statements share one transaction, so the load commits (and syncs) once.
+        with con:
+            for sql, gen in zip(sql_list, gen_list):
+                table = _INSERT_RE.search(sql).group(1)
+                cur = con.executemany(sql, _as_rows(gen))
+                row_counts[table] = row_counts.get(table, 0) + cur.rowcount
+
+            # Hash new rows from their stored values, once type affinity has been applied.
+            for table in row_counts:
+                if table in TABLES:
+                    con.execute(f"UPDATE {table} SET row_hash = hash_row({_hash_columns(table)}) WHERE row_hash IS NULL")
+
+            # Materialized views without triggers are recomputed once per load.
+            for view in _materialized_views(con):
+                for statement in _refresh_view(view):
+                    con.execute(statement)
+
+    for table, row_count in row_counts.items():
+        logger.info("%s: %d rows written", table, row_count)
+
+    return row_counts
+
+
 def db_insert(db_path, sql, tuple_gen):
     """Insert data into a SQLite DB table.
 
@@ -188,133 +706,135 @@ def db_insert(db_path, sql, tuple_gen):
         db_path: String containing the full directory and database name. 
         sql: String containing SQL insertion statement.
         tuple_gen: Generator object containing date tuples to be inserted.
+
+    Returns:
+        row_count: Integer of rows written.
     """
 
-    con = sqlite3.connect(db_path)
-    # TODO: Does row_factory have any impact on performance?
-    con.row_factory = sqlite3.Row
-    
-    with con:
-        con.executemany(sql,tuple_gen)
-        # cur = con.cursor()
-        # row_count = cur.lastrowid
-    con.close()
-    
-    # TODO: Add row_count to logger rather than returned by function.
-    # return row_count
+    return sum(db_bulk_insert(db_path, [sql], [tuple_gen]).values())
 
 
-def db_historical(db_path, gen_list):
-    """Insert data into historical DB tables.
+def _row_hash(*values):
+    """Hash the stored values of a row, registered on load connections as the SQL function hash_row."""
+
+    return hashlib.blake2b(repr(values).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _hash_columns(table):
+    """Return the comma-separated columns of a table that its row hash covers."""
+
+    return ", ".join(col for col, _ in TABLES[table])
+
+
+@functools.lru_cache(maxsize=None)
+def upsert_sql(table, columns, keep_existing=False):
+    """Build an upsert statement that only rewrites rows whose contents changed.
+
+    Conflicting rows have the supplied columns replaced, leaving other columns as
+    they were. The row hash covers the whole resulting row, so loads supplying
+    different columns of the same rows agree, and rewrites of identical data are no-ops.
+    New rows are inserted without a hash, which db_bulk_insert fills in afterwards.
 
     Args:
-        db_path: String containing the full directory and database name. 
-        gen_list: List of generator objects containing date tuples to be inserted.
+        table: String containing the table name.
+        columns: Tuple of strings containing the supplied columns, including date.
+        keep_existing: If True, only insert dates missing from the table and leave
+            existing rows as they are.
+
+    Returns:
+        sql: String containing the SQL upsert statement. Parameters are the
+            supplied columns in order.
     """
 
-    tags_sql = """
-        INSERT INTO exist_tags (
-            alcohol,
-            date,
-            bedsheets,
-            cardio,
-            cleaning,
-            dating,
-            drawing,
-            eating_out,
-            fasting,
-            guitar,
-            laundry,
-            learning,
-            meal_prep,
-            meditation,
-            nap,
-            nutribullet,
-            piano,
-            reading,
-            shopping,
-            tech,
-            travel,
-            tv,
-            walk,
-            writing)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ? ,?, ?,
-                ?, ?, ?, ?, ?, ?, ?, ?, ?, ? ,?, ?)
-        ON CONFLICT(date) DO UPDATE SET date = excluded.date
+    insert = f"""
+        INSERT INTO {table} ({", ".join(columns)}, row_hash)
+        VALUES ({", ".join("?" * len(columns))}, NULL)
         """
 
-    exist_mood_sql = """
-        INSERT INTO exist_journal
-            (mood, date, entry)
-        VALUES (?, ?, ?)
-        ON CONFLICT(date) DO UPDATE SET date = excluded.date
-        """
+    if keep_existing:
+        return insert + "ON CONFLICT(date) DO NOTHING\n"
 
-    exist_time_sql = """
-        INSERT INTO exist_time
-            (prd_mins, date, dst_mins, neut_mins)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(date) DO UPDATE SET date = excluded.date
-        """
+    updates = ",\n                ".join(f"{col} = excluded.{col}" for col in columns if col != 'date')
+    # Values after the update, with type affinity applied, exactly as they will be stored.
+    merged = ", ".join(f"excluded.{col}" if col in columns else f"{table}.{col}" for col, _ in TABLES[table])
 
-    exist_fit_sql = """
-        INSERT INTO exist_fitness (
-            active_cal,
-            date,
-            pulse,
-            pulse_max,
-            pulse_rest,
-            steps,
-            weight,
-            sleep,
-            sleep_end,
-            sleep_start)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(date) DO UPDATE SET date = excluded.date
+    return insert + f"""ON CONFLICT(date) DO UPDATE SET
+                {updates},
+                row_hash = hash_row({merged})
+            WHERE {table}.row_hash IS NOT hash_row({merged})
         """
 
-    mood_charts_sql = """
-        INSERT INTO mood_charts (
-            date,
-            mood,
-            sleep,
-            cardio,
-            meditate,
-            mood_note)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(date) DO UPDATE SET date = excluded.date
-        """
 
-    bullet_sql = """
-        INSERT INTO bullet_journal (
-            date,
-            mood,
-            sleep,
-            steps,
-            cardio,
-            meditate,
-            mood_note,
-            fasting,
-            cheat_meals,
-            read,
-            draw,
-            learn,
-            write,
-            guitar)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(date) DO UPDATE SET date = excluded.date
-        """
-    
-    sql_list = [tags_sql,
-                exist_mood_sql,
-                exist_time_sql,
-                exist_fit_sql,
-                mood_charts_sql,
-                bullet_sql,
-                ]
+def db_upsert(db_path, table_list, gen_list):
+    """Upsert data into several DB tables over one connection in one transaction.
+
+    Args:
+        db_path: String containing the full directory and database name.
+        table_list: List of tuples of table names and the columns supplied for each,
+            optionally followed by True to only insert dates missing from the table.
+            The same table may appear more than once with different columns.
+        gen_list: List of generator objects containing date tuples, or DataFrames,
+            to be inserted in the same order as table_list.
+
+    Returns:
+        row_counts: Dictionary of table names and the number of rows written.
+    """
+
+    # Databases created before the row_hash column are upgraded first, e.g. by weekly runs.
+    db_migrate(db_path)
 
-    for sql, gen in zip(sql_list, gen_list):
-        db_insert(db_path, sql, gen)
+    # Statements are cached, so the same SQL string is reused and sqlite3 compiles it once.
+    sql_list = [upsert_sql(table, tuple(columns), *keep_existing) for table, columns, *keep_existing in table_list]
+
+    return db_bulk_insert(db_path, sql_list, gen_list)
+
+
+def merge_backfill(columns, rows, backfill_columns, backfill_rows, keep_existing=False):
+    """Merge backfill values into rows of the same table by date, so each date is upserted once.
+
+    Args:
+        columns: List of strings containing the columns of rows, including date.
+        rows: Iterable of row tuples, or a DataFrame.
+        backfill_columns: List of strings containing the columns of the backfill rows, including date.
+        backfill_rows: Iterable of backfill row sequences.
+        keep_existing: If True, rows win over backfill values for the same date.
+
+    Returns:
+        rows: List of row tuples with backfill values merged in.
+        leftover: List of backfill row tuples for dates missing from rows.
+    """
+
+    rows = [list(row) for row in _as_rows(rows)]
+    # Dates are matched as SQLite stores them, so date objects match ISO strings.
+    by_date = {str(row[columns.index('date')]): row for row in rows}
+    positions = [(i, columns.index(col)) for i, col in enumerate(backfill_columns)]
+
+    leftover = []
+
+    for backfill in backfill_rows:
+        row = by_date.get(str(backfill[backfill_columns.index('date')]))
+
+        if row is None:
+            leftover.append(tuple(backfill))
+        elif not keep_existing:
+            for i, j in positions:
+                row[j] = backfill[i]
+
+    return [tuple(row) for row in rows], leftover
+
+
+def db_historical(db_path, gen_list):
+    """Insert data into historical DB tables.
+
+    Args:
+        db_path: String containing the full directory and database name. 
+        gen_list: List of generator objects containing date tuples to be inserted.
+
+    Returns:
+        row_counts: Dictionary of table names and the number of rows written.
+    """
+
+    return db_upsert(db_path, HISTORICAL_TABLES, gen_list)
 
 
 def db_prod(db_path, gen_list):
@@ -323,97 +843,126 @@ def db_prod(db_path, gen_list):
     Args:
         db_path: String containing the full directory and database name. 
         gen_list: Generator object containing date tuples to be inserted.
+
+    Returns:
+        row_counts: Dictionary of table names and the number of rows written.
     """
 
-    rt_sql = """
-        INSERT INTO rescuetime
-        (date, prd_hours, dst_hours, neut_hours)
-        VALUES (?, ?, ?, ?)
-        ON CONFLICT(date) DO UPDATE SET date = excluded.date
-        """
+    return db_upsert(db_path, PROD_TABLES, gen_list)
 
-    rmrkble_sql = """
-        INSERT INTO remarkable
-            (date, mood, entry)
-        VALUES (?, ?, ?)
-        ON CONFLICT(date) DO UPDATE SET date = excluded.date
-        """
 
-    fit_sql = """
-        INSERT INTO fitness (
-            date,
-            weight,
-            bmr,
-            pulse,
-            sleep,
-            deep_sleep,
-            light_sleep,
-            rem_sleep,
-            awakes,
-            daily_steps,
-            calories_out)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(date) DO UPDATE SET date = excluded.date
-        """
+def _backup_jsonl(cur, path, columns, batch_size):
+    """Stream query results into a gzip-compressed JSON Lines file."""
+
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for batch in iter(lambda: cur.fetchmany(batch_size), []):
+            f.writelines(json.dumps(dict(zip(columns, row))) + "\n" for row in batch)
+
+
+def _arrow_type(storage, type_):
+    """Choose the Arrow type of a column from the SQLite storage classes of its values.
+
+    Declared types only apply to columns holding nothing but NULLs, since SQLite may
+    store REAL or TEXT values in columns declared integer or float.
+    """
+
+    import pyarrow as pa
+
+    storage = set(storage) - {'null'}
+
+    if not storage:
+        return {'text': pa.string(), 'float': pa.float64(), 'integer': pa.int64()}.get(type_.lower(), pa.string())
+    if storage == {'integer'}:
+        return pa.int64()
+    if storage <= {'integer', 'real'}:
+        return pa.float64()
+    if storage == {'blob'}:
+        return pa.binary()
+
+    # Columns mixing text with other values are written as text, so nothing is lost.
+    return pa.string()
 
-    ntrtn_sql = """
-        INSERT INTO nutrition (
-            date,
-            calories,
-            total_fat,
-            total_carbs,
-            protein,
-            sat_fat,
-            sodium,
-            net_carbs)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ON CONFLICT(date) DO UPDATE SET date = excluded.date
-        """
 
-    sql_list = [rt_sql,
-                rmrkble_sql,
-                fit_sql,
-                ntrtn_sql,
-                ]
+def _backup_parquet(cur, path, columns, types, storage, batch_size):
+    """Stream query results into a Parquet file, one row group per batch."""
 
-    for sql, gen in zip(sql_list, gen_list):
-        db_insert(db_path, sql, gen)
+    # pyarrow is only required for Parquet backups.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
 
+    schema = pa.schema([(col, _arrow_type(classes, type_)) for col, type_, classes in zip(columns, types, storage)])
 
-def db_backup(db_path):
-    """Query entire database and save as .pkl and json objects.
+    def column(values, field):
+        if pa.types.is_string(field.type):
+            values = [value if value is None or isinstance(value, str) else str(value) for value in values]
+        return pa.array(values, type=field.type)
+
+    with pq.ParquetWriter(path, schema, compression='zstd') as writer:
+        for batch in iter(lambda: cur.fetchmany(batch_size), []):
+            arrays = [column(values, field) for values, field in zip(zip(*batch), schema)]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+
+
+def db_backup(db_path, backup_dir=None, fmt='jsonl', batch_size=1000):
+    """Export every table and view in the database to per-table backup files.
+
+    Rows are streamed with fetchmany, so no table is held in memory at once, and
+    all tables are read inside one transaction so the files form a consistent snapshot.
 
     Args:
         db_path: String containing the full directory and database name. 
+        backup_dir: String containing the directory for backup files. Defaults to
+            a 'backup' directory next to the database.
+        fmt: Backup format. 'jsonl' writes gzip-compressed JSON Lines, 'parquet'
+            writes columnar Parquet files (requires pyarrow), and 'sqlite' writes
+            a page-level copy of the whole database with the online backup API.
+        batch_size: Number of rows (or pages for 'sqlite') copied per step.
 
     Returns:
-        Pickle and json files for each DB table.
+        backup_files: List of strings containing the paths of the backup files.
     """
 
-    con = sqlite3.connect(db_path)
-    cur = con.cursor()
+    backup_dir = backup_dir or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'backup')
+    os.makedirs(backup_dir, exist_ok=True)
+
+    with closing(sqlite3.connect(db_path)) as con:
+
+        if fmt == 'sqlite':
+            path = os.path.join(backup_dir, f"{os.path.basename(db_path)}.sqlite")
+
+            with closing(sqlite3.connect(path)) as target:
+                con.backup(target, pages=batch_size)
+
+            return [path]
+
+        backup_files = []
+
+        # Views first, then historical tables, then production tables.
+        tables = {**{view: spec['columns'] for view, spec in VIEWS.items()}, **TABLES}
+
+        # Hold one read transaction so every file comes from the same snapshot.
+        con.execute("BEGIN")
 
-    # Query from views
-    cur.execute("select * from journal_view order by date")
-    cur.execute("select * from rescuetime_view order by date")
+        for table, table_columns in tables.items():
+            columns, types = zip(*[(col, decl.split()[0]) for col, decl in table_columns])
 
-    # Query from historical tables
-    cur.execute("select * from exist_tags order by date")
-    cur.execute("select * from exist_journal order by date")
-    cur.execute("select * from exist_time order by date")
-    cur.execute("select * from exist_fitness order by date")
-    cur.execute("select * from mood_charts order by date")
-    cur.execute("select * from bullet_journal order by date")
+            cur = con.execute(f"select {', '.join(columns)} from {table} order by date")
 
-    # Query from production tables
-    cur.execute("select * from rescuetime order by date")
-    cur.execute("select * from remarkable order by date")
-    cur.execute("select * from fitness order by date")
-    cur.execute("select * from nutrition order by date")
+            if fmt == 'jsonl':
+                path = os.path.join(backup_dir, f"{table}.jsonl.gz")
+                _backup_jsonl(cur, path, columns, batch_size)
+            elif fmt == 'parquet':
+                path = os.path.join(backup_dir, f"{table}.parquet")
+                storage = con.execute(
+                    f"select {', '.join(f'group_concat(distinct typeof({col}))' for col in columns)} from {table}"
+                    ).fetchone()
+                storage = [(classes or '').split(',') for classes in storage]
+                _backup_parquet(cur, path, columns, types, storage, batch_size)
+            else:
+                raise ValueError(f"Unknown backup format: {fmt}")
 
-    # TODO: Add this to each execution and create a list for pkl and jsonification
-    results = cur.fetchall()
+            backup_files.append(path)
 
-    con.close()
+        con.rollback()
 
-    pass
+    return backup_files
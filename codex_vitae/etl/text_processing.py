@@ -2,18 +2,91 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import re
+import time
+import pickle
+import hashlib
+import sqlite3
+import logging
+import functools
+import itertools
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
 from dateutil.parser import parse
 
-from datetime import date
-from dateutil.relativedelta import relativedelta
+from datetime import date, datetime
+
+from html.parser import HTMLParser
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_COLSPAN_RE = re.compile(r'colspan=\W*(\d+)')
+# Line breaks and runs of whitespace within table cells, as normalized by pandas.read_html.
+_WHITESPACE_RE = re.compile(r'[\r\n]+|\s{2,}')
+
+# Bodies of emails with PDF attachments instead of text, decoded and as bytes reprs.
+_PDF_BODIES = {"b'6\\x89\\xde'", b'6\x89\xde'.decode('utf-8', errors='replace')}
+
+# Date formats of reMarkable journal headers (e.g. 'Sat, Jan 1,2022') and MyNetDiary
+# tables (e.g. 'Monday, January 3'), tried in order before falling back to dateutil.
+DATE_FORMATS = [
+    '%a, %b %d,%Y',
+    '%a, %b %d, %Y',
+    '%A, %B %d,%Y',
+    '%A, %B %d, %Y',
+    '%A, %B %d',
+    '%A, %b %d',
+]
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_date(text: str, default_year: int) -> date:
+    """Cached implementation of parse_date."""
+
+    for fmt in DATE_FORMATS:
+        try:
+            parsed = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+
+        if '%Y' not in fmt:
+            parsed = parsed.replace(year=default_year)
+
+        return parsed.date()
+
+    # Unknown formats (and Feb 29 without a year) fall back to dateutil.
+    return parse(text, default=datetime(default_year, 1, 1)).date()
+
+
+def parse_date(text: str, default_year: int = None) -> date:
+    """Parse a date string, trying known formats before dateutil and memoizing results.
+
+    Args:
+        text: A string containing a date.
+        default_year: Year for dates without one. Defaults to the current year.
+
+    Returns:
+        date_: Date as datetime type.
+    """
+
+    return _parse_date(text.strip(), default_year or date.today().year)
 
-import pandas as pd
-#lxml required for pandas to parse html tables
 
 class reMarkableParsing:
     """Extract date, mood rating, and journal entry from raw email bodies."""
 
+    # Patterns are compiled once for all emails.
+    tag_re = re.compile(r'<[^>]+>')
+    # Cleaned entries read "<date>Mood: <rating><entry>", where the rating is a digit and the
+    # entry ends at the next colon. Emails without a labeled rating are not journal entries.
+    entry_re = re.compile(r'(?P<head>[^:]*?)[Mm]ood\s*:\s*(?P<mood>\d)(?P<entry>[^:]*)')
+    mood_re = re.compile(r'Mood|mood')
+
+    footer = "--Sent from my reMarkable paper tabletGet yours at www.remarkable.comPS: You cannot reply to this email"
+
     def clean_emails(self, text: str) -> str:
         """Removes HTML and CSS syntax, line breaks, and footer from journal entries.
 
@@ -25,16 +98,15 @@ class reMarkableParsing:
         """
 
         # Remove HTML tags
-        tag_re = re.compile(r'<[^>]+>')
-        text = tag_re.sub('', text)
-        # Remove line breaks
-        text = text.replace("\\r\\n","")
+        text = self.tag_re.sub('', text)
+        # Remove line breaks, either decoded or escaped in bytes reprs from older extracts
+        text = text.replace("\r\n","").replace("\\r\\n","")
         # Remove apostrophe breaks
         text = text.replace("\\'","")
         # Remove CSS syntx
-        text = text.replace("b'p, li { white-space: pre-wrap; }","")
+        text = text.replace("b'p, li { white-space: pre-wrap; }","").replace("p, li { white-space: pre-wrap; }","")
         # Remove Remarkable Footer
-        clean_text = text.replace("--Sent from my reMarkable paper tabletGet yours at www.remarkable.comPS: You cannot reply to this email'","")
+        clean_text = text.replace(self.footer + "'","").replace(self.footer,"")
 
         return clean_text
     
@@ -47,10 +119,7 @@ class reMarkableParsing:
             date: Date as datetime type.
         """
 
-        try:
-            date_ = parse(text.split("Mood")[0]).date()    
-        except:
-            date_ = parse(text.split("mood")[0]).date()
+        date_ = parse_date(self.mood_re.split(text, 1)[0])
      
         return date_
 
@@ -64,7 +133,7 @@ class reMarkableParsing:
             rating: Mood rating as a float.
         """
 
-        rating = float(text.split(":")[1].strip()[0])
+        rating = float(self.entry_re.match(text).group('mood'))
 
         return rating
 
@@ -77,133 +146,552 @@ class reMarkableParsing:
             entry: A string of journal entry.
         """
 
-        entry = str(text.split(":")[1]).strip()[1:].strip()
+        entry = self.entry_re.match(text).group('entry').strip()
 
         return entry
+
+    def parse(self, email_: str):
+        """Extracts date, mood rating and journal entry from a raw email in one scan.
+
+        Args:
+            email_: A string of raw email text.
+
+        Returns:
+            journal: A tuple of the date, mood rating and journal entry, or None if
+                the email does not contain a dated journal entry.
+        """
+
+        match = self.entry_re.match(self.clean_emails(email_))
+
+        if match is None:
+            return None
+
+        try:
+            date_ = self.journal_date(match.group('head'))
+        except (ValueError, OverflowError):
+            return None
+
+        return (date_,
+                float(match.group('mood')),
+                match.group('entry').strip(),
+                )
+
+    def iter_run(self, email_list):
+        """Lazily parses journal data from an iterable of raw emails.
+
+        Args:
+            email_list: An iterable of strings containing raw emails to be processed.
+
+        Yields:
+            journal: A tuple of parsed journal data for each email containing an entry.
+        """
+
+        for email_ in email_list:
+            # Emails containing PDF attachments instead of text must be skipped.
+            if email_ in _PDF_BODIES:
+                continue
+
+            journal = self.parse(email_)
+
+            if journal is None:
+                logger.warning("Skipping email without a journal entry: %.40r", email_)
+                continue
+
+            yield journal
     
     def run(self, email_list):
         """Arranges all journal data in format required for database insertion.
 
+        Args:
+            email_list: An iterable of strings containing raw emails to be processed.
+
         Returns:
-            email_list: A list of strings containing raw emails to be processed.
             journal_tuple: A list of tuples containing parsed journal data.
         """
 
-        # Emails containing PDF attachments instead of text must be removed.
-        for entry in email_list:
-            if entry == "b'6\\x89\\xde'":
-                email_list.remove(entry)
-
-        clean_text = [self.clean_emails(entry) for entry in email_list]
-        mood = [self.mood_rating(entry) for entry in clean_text]
-        date_ = [self.journal_date(entry) for entry in clean_text]
-        journal = [self.journal_entry(entry) for entry in clean_text]
-
-        journal_tuple = [(day,m,j) for (day,m,j) in zip(date_, mood,journal)]
+        journal_tuple = list(self.iter_run(email_list))
         
         return journal_tuple
 
-def fitness_parsing(email_list: list) -> list:
-    """Use Pandas functions to parse fitness data from MyNetDiary emails for database insertion.
+class _ReportScanner(HTMLParser):
+    """Stream the cells of MyNetDiary report tables without building a DOM.
+
+    Each table is stored under the text of the <h2> heading preceding it, as a list of
+    rows. Rows are lists of (text, date) cells, where date holds the text of a hidden
+    'dailyDateNoLink' span marking a daily totals row. Cells spanning several columns
+    are repeated so that row positions line up with the header.
+    """
+
+    def __init__(self, heading: str = ''):
+        super().__init__(convert_charrefs=True)
+        self.tables = {}
+        self.heading = heading
+        self._in_heading = False
+        self._rows = None
+        self._row = None
+        self._cell = None
+        self._span = 1
+        self._date = None
+        self._hidden = None
+        self._hidden_depth = 0
+        self._date_text = None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = ' '.join(f'{k}={v}' for k, v in attrs if v)
+
+        if self._hidden is not None:
+            if tag == self._hidden:
+                self._hidden_depth += 1
+            if 'dailyDateNoLink' in attrs:
+                self._date_text = []
+            return
+
+        if tag == 'h2':
+            self._in_heading = True
+            self.heading = ''
+        elif tag == 'table':
+            self._rows = self.tables.setdefault(self.heading.strip(), [])
+        elif tag == 'tr' and self._rows is not None:
+            self._row = []
+        elif tag in ('td', 'th') and self._row is not None:
+            self._cell, self._date = [], None
+            span = _COLSPAN_RE.search(attrs)
+            self._span = int(span.group(1)) if span else 1
+
+        # Skip text hidden from the rendered report, except for daily date markers.
+        if 'display:none' in attrs.replace(' ', ''):
+            self._hidden, self._hidden_depth = tag, 1
+            if 'dailyDateNoLink' in attrs:
+                self._date_text = []
+
+    def handle_endtag(self, tag):
+        if self._hidden is not None:
+            if tag != self._hidden:
+                return
+            self._hidden_depth -= 1
+            if self._hidden_depth:
+                return
+            self._hidden = None
+            if self._date_text is not None:
+                self._date = ''.join(self._date_text).strip()
+                self._date_text = None
+
+        if tag == 'h2':
+            self._in_heading = False
+        elif tag == 'table':
+            self._rows = None
+        elif tag == 'tr' and self._row is not None:
+            self._rows.append(self._row)
+            self._row = None
+        elif tag in ('td', 'th') and self._cell is not None:
+            text = _WHITESPACE_RE.sub(' ', ''.join(self._cell)).strip()
+            self._row.extend([(text, self._date)] * self._span)
+            self._cell = None
+
+    def handle_data(self, data):
+        if self._hidden is not None:
+            if self._date_text is not None:
+                self._date_text.append(data)
+        elif self._cell is not None:
+            self._cell.append(data)
+        elif self._in_heading:
+            self.heading += data
+
+
+def _cell_value(text: str) -> float:
+    """Convert the text of a table cell into a number, or NaN if empty or not numeric."""
+
+    try:
+        return float(text.replace(',', ''))
+    except ValueError:
+        return np.nan
+
+
+def _select_columns(header: list, columns: list) -> list:
+    """Find the positions of named columns in a table header row."""
+
+    names = [text for text, _ in header]
+
+    return [names.index(col) for col in columns]
+
+
+# Columns selected from the MyNetDiary Measurements and Nutrition tables, as labeled in the emails.
+FITNESS_COLUMNS = [
+    'Date',
+    'Weight, lbs',
+    'BMR, cals',
+    'Pulse,',
+    'Sleep,',
+    'Awakes,',
+    'Light Sleep,',
+    'Deep Sleep,',
+    'Daily Steps,',
+    'Calories Out, cals',
+    ]
+
+# Names of the parsed fitness and nutrition columns, matching the database tables.
+FITNESS_FIELDS = ['date', 'weight', 'bmr', 'pulse', 'sleep', 'deep_sleep', 'light_sleep',
+                  'rem_sleep', 'awakes', 'daily_steps', 'calories_out']
+
+NUTRITION_FIELDS = ['date', 'calories', 'total_fat', 'total_carbs', 'protein', 'sat_fat',
+                    'sodium', 'net_carbs']
+
+NUTRITION_COLUMNS = [
+    'Calories',
+    'Total Fat,\xa0g',
+    'Total Carbs,\xa0g',
+    'Protein,\xa0g',
+    'Saturated Fat,\xa0g',
+    'Sodium,\xa0mg',
+    'Net Carbs,\xa0g',
+    ]
+
+
+def scan_mynetdiary(email_: str) -> tuple:
+    """Scan the Measurements and Nutrition tables of a MyNetDiary email in a single pass.
+
+    Args:
+        email_: String containing raw HTML from a MyNetDiary email.
+    Returns:
+        fitness_rows: A list of tuples of the FITNESS_COLUMNS cells of each day.
+        nutrition_rows: A list of (date string, *NUTRITION_COLUMNS) tuples of the daily totals.
+    """
+
+    start = email_.find("Measurements")
+    end = email_.find("Activities", start)
+    report = email_[start + len("Measurements"):end if end != -1 else None]
+
+    scanner = _ReportScanner(heading="Measurements")
+    scanner.feed(report.replace("\r\n","").replace("\\r\\n",""))
+    scanner.close()
+
+    fitness_table = scanner.tables.get("Measurements", [])
+    nutrition_table = next((rows for heading, rows in scanner.tables.items() if "Nutrition" in heading), [])
+
+    fitness_rows = []
+
+    if fitness_table:
+        idx = _select_columns(fitness_table[0], FITNESS_COLUMNS)
+        fitness_rows = [tuple(row[i][0] for i in idx) for row in fitness_table[1:] if len(row) > max(idx)]
+
+    nutrition_rows = []
+
+    if nutrition_table:
+        # Column names are in the row following the daily targets.
+        header = next((row for row in nutrition_table if any(text == 'Calories' for text, _ in row)), [])
+        idx = _select_columns(header, NUTRITION_COLUMNS)
+        nutrition_rows = [
+            (row[0][1],) + tuple(row[i][0] for i in idx)
+            for row in nutrition_table if row and row[0][1] and len(row) > max(idx)
+            ]
+
+    return fitness_rows, nutrition_rows
+
+
+def report_date(text: str, sent: date = None) -> date:
+    """Date a MyNetDiary report day (e.g. 'Monday, May 10') relative to the date the email was sent.
+
+    Reports cover the week before they are sent, so days after the sent date belong to
+    the previous year (e.g. a NYE week reported on January 2).
+
+    Args:
+        text: A string containing a date without a year.
+        sent: Date the email was sent. Defaults to today.
+
+    Returns:
+        date_: Date as datetime type.
+    """
+
+    sent = sent or date.today()
+    day = parse_date(text, sent.year)
+
+    if (day.month, day.day) > (sent.month, sent.day):
+        day = parse_date(text, sent.year - 1)
+
+    return day
+
+
+def _fill_columns(rows: list, width: int) -> tuple:
+    """Copy scanned rows into a preallocated array of labels and a float array of values."""
+
+    labels = np.empty(len(rows), dtype=object)
+    values = np.full((len(rows), width), np.nan)
+
+    for i, (label, *cells) in enumerate(rows):
+        labels[i] = label
+        values[i] = [_cell_value(text) for text in cells]
+
+    return labels, values
+
+
+def mynetdiary_rows(email_list: list) -> tuple:
+    """Scan MyNetDiary emails into rows of cell text, dating nutrition rows by when each email was sent.
 
     Arguments:
-        email_list: List of strings containing raw HTML from MyNetDiary emails.
+        email_list: List of strings containing raw HTML from MyNetDiary emails. Strings with a
+            sent attribute (e.g. EmailBody) date nutrition rows relative to it instead of today.
     Returns:
-        fitness_tuples: A list of tuples containing pertinent fitness data.
+        fitness_rows: A list of tuples of the FITNESS_COLUMNS cells of each day.
+        nutrition_rows: A list of (date, *NUTRITION_COLUMNS) tuples of the daily totals.
     """
 
-    df_list = []
+    fitness_rows = []
+    nutrition_rows = []
 
     for email_ in email_list:
+        fitness, nutrition = scan_mynetdiary(email_)
+        fitness_rows.extend(fitness)
 
-        # Get substring of Fitness table.
-        fitness_table = email_.split("Measurements")[1].replace("\\r\\n","").split("Nutrition")[0]
-        fitness_df = pd.read_html(fitness_table)[0]
-
-        # Fix mislabled sleep data columns and add a REM sleep column.
-        fitness_df['Deep Sleep'] = fitness_df['Awakes,']
-        fitness_df['Awakes'] = fitness_df['Deep Sleep,']
-        fitness_df['REM Sleep'] = fitness_df['Sleep,'] - fitness_df['Deep Sleep'] - fitness_df['Light Sleep,']
-
-        # Select pertinent columns and append to df list for concatenation.
-        fitness_df = fitness_df[[
-            'Date', 
-            'Weight, lbs', 
-            'BMR, cals',
-            'Pulse,', 
-            'Sleep,',
-            'Deep Sleep', 
-            'Light Sleep,',
-            'REM Sleep',
-            'Awakes',
-            'Daily Steps,',
-            'Calories Out, cals'
-            ]]
-
-        df_list.append(fitness_df)
-
-    fitness_df = pd.concat(df_list,axis=0)
-    
-    # Convert dataframe into list of tuples.
-    fitness_tuples = list(fitness_df.itertuples(index=False,name=None))
+        # Years are inferred from the sent date carried by the email, so parsing does not depend on when it runs.
+        sent = getattr(email_, 'sent', None) or date.today()
+        nutrition_rows.extend((report_date(day, sent), *cells) for day, *cells in nutrition)
+
+    return fitness_rows, nutrition_rows
+
+
+def mynetdiary_columns(rows: tuple, as_frame: bool = False) -> tuple:
+    """Assemble scanned MyNetDiary rows into fitness and nutrition data for database insertion.
+
+    Rows from all emails are accumulated into one array per column, so derived columns
+    are computed once for the whole batch.
+
+    Arguments:
+        rows: A tuple of the fitness and nutrition rows returned by mynetdiary_rows.
+        as_frame: Return a DataFrame for each table instead of a list of tuples.
+    Returns:
+        fitness_tuples: A list of tuples (or DataFrame) containing pertinent fitness data.
+        nutrition_tuples: A list of tuples (or DataFrame) containing pertinent nutrition data.
+    """
+
+    fitness_rows, nutrition_rows = rows or ([], [])
+
+    dates, fitness = _fill_columns(fitness_rows, len(FITNESS_COLUMNS) - 1)
+    weight, bmr, pulse, sleep, deep, light, awakes, steps, calories = fitness.T
+
+    # Sleep data columns are mislabeled; REM sleep is the remainder of total sleep.
+    fitness_columns = [dates, weight, bmr, pulse, sleep, deep, light, sleep - deep - light, awakes, steps, calories]
+
+    days, nutrition = _fill_columns(nutrition_rows, len(NUTRITION_COLUMNS))
+    nutrition_columns = [days, *nutrition.T]
+
+    if as_frame:
+        import pandas as pd
+
+        return (pd.DataFrame(dict(zip(FITNESS_FIELDS, fitness_columns))),
+                pd.DataFrame(dict(zip(NUTRITION_FIELDS, nutrition_columns))))
 
-    return fitness_tuples
+    fitness_tuples = list(zip(*(column.tolist() for column in fitness_columns)))
+    nutrition_tuples = list(zip(*(column.tolist() for column in nutrition_columns)))
 
-def nutrition_parsing(email_list: list) -> list:
-    """Use Pandas functions to parse nutrition data from MyNetDiary emails for database insertion.
+    return fitness_tuples, nutrition_tuples
+
+
+def mynetdiary_parsing(email_list: list, as_frame: bool = False) -> tuple:
+    """Parse fitness and nutrition data from MyNetDiary emails for database insertion, scanning each email once.
+
+    Arguments:
+        email_list: List of strings containing raw HTML from MyNetDiary emails. Strings with a
+            sent attribute (e.g. EmailBody) date nutrition rows relative to it instead of today.
+        as_frame: Return a DataFrame for each table instead of a list of tuples.
+    Returns:
+        fitness_tuples: A list of tuples (or DataFrame) containing pertinent fitness data.
+        nutrition_tuples: A list of tuples (or DataFrame) containing pertinent nutrition data.
+    """
+
+    return mynetdiary_columns(mynetdiary_rows(email_list), as_frame)
+
+
+def fitness_parsing(email_list: list, as_frame: bool = False) -> list:
+    """Parse fitness data from MyNetDiary emails for database insertion.
 
     Arguments:
         email_list: List of strings containing raw HTML from MyNetDiary emails.
+        as_frame: Return a DataFrame instead of a list of tuples.
+    Returns:
+        fitness_tuples: A list of tuples containing pertinent fitness data.
+    """
+
+    return mynetdiary_parsing(email_list, as_frame)[0]
+
+
+def nutrition_parsing(email_list: list, as_frame: bool = False) -> list:
+    """Parse nutrition data from MyNetDiary emails for database insertion.
+
+    Arguments:
+        email_list: List of strings containing raw HTML from MyNetDiary emails.
+        as_frame: Return a DataFrame instead of a list of tuples.
     Returns:
         nutrition_tuples: A list of tuples containing pertinent nutrition data.
     """
 
-    df_list = []
+    return mynetdiary_parsing(email_list, as_frame)[1]
 
-    for email_ in email_list:
 
-        # Get substring of Nutrition table.
-        nutrition_table = email_.split("Measurements")[1].replace("\\r\\n","").split("Nutrition")[1].split("Activities")[0]
-
-        # Find the indices of the days of the week for date assignments.
-        mon_idx = nutrition_table.find('Monday')
-        tue_idx = nutrition_table.find('Tuesday')
-        wed_idx = nutrition_table.find('Wednesday')
-        thu_idx = nutrition_table.find('Thursday')
-        fri_idx = nutrition_table.find('Friday')
-        sat_idx = nutrition_table.find('Saturday')
-        sun_idx = nutrition_table.find('Sunday')
-
-        day_find = [mon_idx,tue_idx,wed_idx,thu_idx,fri_idx,sat_idx,sun_idx]
-
-        # Find date strings in HTML table and format as dates.
-        date_list = [parse(nutrition_table[day:].split("</span")[0]).date() for day in day_find if day is not -1]
-
-        # Revert to previous year for NYE week.
-        date_list = [(day - relativedelta(years=1) if date.today().strftime("%m%d") < day.strftime("%m%d") else day) for day in date_list]
-
-        nutrition_df = pd.read_html(nutrition_table,parse_dates=True,header=1)
-
-        # Retrieve rows containing daily totals.
-        nutrition_df = nutrition_df[0][nutrition_df[0]['Unnamed: 0'].isnull()].reset_index()
-        nutrition_df['Date'] = date_list
-
-        # Select pertinent columns and append to df list for concatenation.
-        nutrition_df = nutrition_df[[
-            'Date',
-            'Calories',
-            'Total Fat,\xa0g',
-            'Total Carbs,\xa0g',
-            'Protein,\xa0g',
-            'Saturated Fat,\xa0g',
-            'Sodium,\xa0mg',
-            'Net Carbs,\xa0g',
-            ]]
-        
-        df_list.append(nutrition_df)
+def _merge_results(results: list):
+    """Concatenate parser results from consecutive chunks, element-wise for tuples of lists."""
+
+    if results and isinstance(results[0], tuple):
+        return tuple(_merge_results(list(parts)) for parts in zip(*results))
+
+    return list(itertools.chain.from_iterable(results))
+
+
+def parallel_parse(parser, emails, chunk_size: int = 25, max_workers: int = None, min_emails: int = 100):
+    """Fan emails out to a process pool in chunks and merge the parsed results in order.
+
+    Batches smaller than min_emails (e.g. weekly runs) are parsed serially in this process.
+    Emails may be a generator, in which case chunks are submitted as they arrive.
+
+    Args:
+        parser: Picklable function taking a list of emails and returning a list, or a tuple of lists.
+        emails: Iterable of strings containing raw email bodies.
+        chunk_size: Number of emails sent to a worker at a time.
+        max_workers: Number of worker processes. Defaults to the number of CPUs.
+        min_emails: Minimum number of emails to start a process pool for.
+
+    Returns:
+        results: Output of parser over all emails, in input order.
+    """
+
+    emails = iter(emails)
+    head = list(itertools.islice(emails, min_emails))
+    max_workers = max_workers or os.cpu_count() or 1
+
+    if len(head) < min_emails or max_workers < 2:
+        head.extend(emails)
+        return parser(head)
+
+    chunks = iter(lambda: list(itertools.islice(emails, chunk_size)), [])
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(parser, head[i:i + chunk_size]) for i in range(0, len(head), chunk_size)]
+        futures.extend(executor.submit(parser, chunk) for chunk in chunks)
+
+        results = [future.result() for future in futures]
+
+    logger.info("Parsed %d chunks of emails with %d processes", len(results), max_workers)
+
+    return _merge_results(results)
+
+
+# Versions of each parser's output. Bump a version when a parser changes, so results
+# cached by ParseCache under the old version are parsed again.
+PARSER_VERSIONS = {
+    'remarkable': '1',
+    'mynetdiary': '2',
+}
 
-    nutrition_df = pd.concat(df_list,axis=0)
 
-    nutrition_tuples = list(nutrition_df.itertuples(index=False,name=None))
+def _parse_each(parser, emails: list) -> list:
+    """Run a parser on each email separately, returning one result per email."""
+
+    return [parser([email_]) for email_ in emails]
+
+
+class ParseCache:
+    """Cache parsed results of email bodies in SQLite, keyed by a hash of the body and parser version.
+
+    Emails are parsed again only when they are new or their parser version changes. Least
+    recently used results are evicted once the cache grows beyond max_bytes.
+
+    Args:
+        db_path: A string containing the full directory and database name.
+        max_bytes: Maximum total size of the pickled results.
+    """
+
+    def __init__(self, db_path, max_bytes=64 * 2**20):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+
+        with closing(sqlite3.connect(db_path)) as con:
+            con.execute("""
+                CREATE TABLE IF NOT EXISTS parse_cache(
+                    key text PRIMARY KEY,
+                    parser text NOT NULL,
+                    version text NOT NULL,
+                    result blob NOT NULL,
+                    size integer NOT NULL,
+                    accessed float NOT NULL
+                )
+                """)
+
+    @staticmethod
+    def key(name: str, version: str, email_: str) -> str:
+        """Hash an email body, its sent date if known, and the parser name and version."""
+
+        sent = getattr(email_, 'sent', None)
+        digest = hashlib.blake2b(f'{name}\0{version}\0{sent}\0'.encode('utf-8'), digest_size=16)
+        digest.update(email_.encode('utf-8', errors='surrogatepass'))
+
+        return digest.hexdigest()
+
+    def parse(self, name: str, parser, emails, assemble=None, **kwargs):
+        """Parse emails, reusing cached results and parsing the rest with parallel_parse.
+
+        The output of parser is cached for each email. Work done once per batch, such as
+        building column arrays, belongs in assemble, which runs on the output for all emails.
+
+        Args:
+            name: Name of the parser in PARSER_VERSIONS.
+            parser: Picklable function taking a list of emails and returning a list, or a tuple of lists.
+            emails: Iterable of strings containing raw email bodies.
+            assemble: Optional function applied to the merged output of parser over all emails.
+            **kwargs: Keyword arguments passed to parallel_parse.
+
+        Returns:
+            results: Output of parser over all emails, in input order, passed through assemble if given.
+        """
 
-    return nutrition_tuples
+        version = PARSER_VERSIONS[name]
+        emails = list(emails)
+        keys = [self.key(name, version, email_) for email_ in emails]
+
+        with closing(sqlite3.connect(self.db_path)) as con:
+            with con:
+                # Results of previous parser versions can never be hit again.
+                con.execute("DELETE FROM parse_cache WHERE parser = ? AND version != ?", (name, version))
+
+                results = {}
+                for i in range(0, len(keys), 500):
+                    chunk = keys[i:i + 500]
+                    results.update(con.execute(
+                        f"SELECT key, result FROM parse_cache WHERE key IN ({', '.join('?' * len(chunk))})",
+                        chunk,
+                        ).fetchall())
+
+                con.executemany("UPDATE parse_cache SET accessed = ? WHERE key = ?",
+                                [(time.time(), key) for key in results])
+
+        results = {key: pickle.loads(result) for key, result in results.items()}
+        missing = {key: email_ for key, email_ in zip(keys, emails) if key not in results}
+
+        if missing:
+            parsed = parallel_parse(functools.partial(_parse_each, parser), list(missing.values()), **kwargs)
+            results.update(zip(missing, parsed))
+            self.put(name, version, dict(zip(missing, parsed)))
+
+        logger.info("%s: %d emails parsed, %d read from cache", name, len(missing), len(keys) - len(missing))
+
+        results = _merge_results([results[key] for key in keys])
+
+        return results if assemble is None else assemble(results)
+
+    def put(self, name: str, version: str, results: dict):
+        """Store a dictionary of keys and parsed results, then evict the least recently used."""
+
+        blobs = {key: pickle.dumps(result) for key, result in results.items()}
+
+        with closing(sqlite3.connect(self.db_path)) as con:
+            with con:
+                con.executemany(
+                    "INSERT OR REPLACE INTO parse_cache (key, parser, version, result, size, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(key, name, version, blob, len(blob), time.time()) for key, blob in blobs.items()],
+                    )
+                con.execute("""
+                    DELETE FROM parse_cache WHERE key IN (
+                        SELECT key FROM (
+                            SELECT key, SUM(size) OVER (ORDER BY accessed DESC, key) AS total
+                            FROM parse_cache
+                        ) WHERE total > ?
+                    )
+                    """, (self.max_bytes,))
@@ -11,27 +11,30 @@ import datetime
 from dateutil.relativedelta import relativedelta
 
 from sqlite_module import db_prod, db_backup
-from api_requests import authenticate_gmail_api, get_email_content, get_rescuetime_daily
-from text_processing import reMarkableParsing, fitness_parsing, nutrition_parsing
+from api_requests import authenticate_gmail_api, get_email_content, get_rescuetime_daily, MessageCache
+from text_processing import reMarkableParsing, mynetdiary_rows, mynetdiary_columns, ParseCache
 
 
 os.chdir(os.getenv('CONFIG'))
 
 date_ = str(date.today()-relativedelta(days=14))
 
+# Emails already downloaded and parsed by earlier runs are read from local caches.
+_cache = MessageCache(os.getenv('DB_PATH'))
+_parse_cache = ParseCache(os.getenv('DB_PATH'))
+
 # Return last two weeks of emails for MyNetDiary nutrition reports.
 with authenticate_gmail_api(os.getenv('CREDENTIALS')) as service:
-    _remarkable = get_email_content(service,query=f"from:my@remarkable.com,after:{date_}")
-    _mynetdiary = get_email_content(service,query=f"from:no-reply@mynetdiary.net,after:{date_}")
+    _remarkable = get_email_content(service,query=f"from:my@remarkable.com,after:{date_}",cache=_cache)
+    _mynetdiary = get_email_content(service,query=f"from:no-reply@mynetdiary.net,after:{date_}",cache=_cache)
 
 _rescuetime = get_rescuetime_daily(os.getenv('API_KEY'))
 
-# Convert reMarkable and MyNetDiary data into tuple generators.
-_remarkable = reMarkableParsing().run(_remarkable)
+# Convert reMarkable and MyNetDiary data into tuple generators, parsing only emails new since the last run.
+_remarkable = _parse_cache.parse('remarkable', reMarkableParsing().run, _remarkable)
 
 if _mynetdiary is not None:
-    _fitness = fitness_parsing(_mynetdiary)
-    _nutrition = nutrition_parsing(_mynetdiary)
+    _fitness, _nutrition = _parse_cache.parse('mynetdiary', mynetdiary_rows, _mynetdiary, assemble=mynetdiary_columns)
 
     _prod_list = [_rescuetime,
                   _remarkable,
@@ -0,0 +1,152 @@
+import os
+import sys
+import base64
+
+import pytest
+
+# Modules such as orm_inserts import their siblings as the etl package, the way the app runs them,
+# while ETL scripts such as raw_etl import them as top-level modules from the etl directory.
+_APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'codex_vitae')
+sys.path[:0] = [_APP_DIR, os.path.join(_APP_DIR, 'etl')]
+
+
+class FakeRequest:
+    """Stand-in for a googleapiclient HttpRequest."""
+
+    def __init__(self, handler, **kwargs):
+        self._handler = handler
+        self._kwargs = kwargs
+
+    def execute(self, http=None):
+        return self._handler(**self._kwargs)
+
+
+class FakeBatch:
+    """Stand-in for a googleapiclient BatchHttpRequest."""
+
+    def __init__(self, service, callback):
+        self._service = service
+        self._callback = callback
+        self._requests = []
+
+    def add(self, request, request_id=None):
+        self._requests.append((request_id, request))
+
+    def execute(self):
+        self._service.calls['batch'] += 1
+
+        for request_id, request in self._requests:
+            self._callback(request_id, request.execute(), None)
+
+
+class FakeGmailService:
+    """In-memory stand-in for the GMail API service object.
+
+    Args:
+        bodies: A list of raw email body strings, newest first.
+        multipart: If True, return bodies as the HTML part of container MIME messages.
+    """
+
+    def __init__(self, bodies, multipart=False):
+        self.multipart = multipart
+        self.calls = {'list': 0, 'get': 0, 'batch': 0, 'history': 0}
+        self.closed = False
+        self.history_id = 1
+        self.history_ = []
+        self.messages_ = {}
+        self.senders_ = {}
+
+        for body in reversed(bodies):
+            self.add_message(body)
+
+    def add_message(self, body, sender=None):
+        """Deliver a new email, which is listed first and recorded in the mailbox history.
+
+        Emails with a sender are only listed by queries containing from:<sender>.
+        """
+
+        id_ = str(len(self.messages_))
+
+        if sender is not None:
+            self.senders_[id_] = sender
+
+        data = base64.urlsafe_b64encode(body.encode('utf-8')).decode('ascii')
+        self.messages_ = {id_: data, **self.messages_}
+        self.history_id += 1
+        self.history_.append((self.history_id, id_))
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return self
+
+    def history(self):
+        return self
+
+    def getProfile(self, userId):
+        return FakeRequest(lambda: {'historyId': str(self.history_id)})
+
+    def list(self, userId, q=None, maxResults=100, includeSpamTrash=False, pageToken=None,
+             startHistoryId=None, historyTypes=None):
+        if startHistoryId is not None:
+            return FakeRequest(self._history, startHistoryId=startHistoryId)
+
+        return FakeRequest(self._list, q=q, maxResults=maxResults, pageToken=pageToken)
+
+    def get(self, userId, id, format=None, fields=None):
+        return FakeRequest(self._get, id=id)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
+
+    def close(self):
+        self.closed = True
+
+    def _list(self, q, maxResults, pageToken):
+        self.calls['list'] += 1
+
+        ids = [id_ for id_ in self.messages_
+               if q is None or id_ not in self.senders_ or f"from:{self.senders_[id_]}" in q]
+        start = int(pageToken or 0)
+        page = ids[start:start+maxResults]
+
+        response = {'resultSizeEstimate': len(page)}
+
+        if page:
+            response['messages'] = [{'id': id_, 'threadId': id_} for id_ in page]
+        if start + maxResults < len(ids):
+            response['nextPageToken'] = str(start + maxResults)
+
+        return response
+
+    def _get(self, id):
+        self.calls['get'] += 1
+
+        data = self.messages_[id]
+
+        if self.multipart:
+            payload = {'body': {'size': 0}, 'parts': [{'body': {'data': data}}, {'body': {'data': data}}]}
+        else:
+            payload = {'body': {'data': data}}
+
+        return {'id': id, 'internalDate': str(1641000000000 + int(id)), 'payload': payload}
+
+    def _history(self, startHistoryId):
+        self.calls['history'] += 1
+
+        added = [id_ for history_id, id_ in self.history_ if history_id > int(startHistoryId)]
+
+        response = {'historyId': str(self.history_id)}
+
+        if added:
+            response['history'] = [{'messagesAdded': [{'message': {'id': id_}} for id_ in added]}]
+
+        return response
+
+
+@pytest.fixture
+def gmail_service():
+    """Return a factory for fake GMail API service objects."""
+
+    return FakeGmailService
@@ -3,13 +3,16 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import sqlite3
 
 from contextlib import closing
 
 from datetime import date
 from dateutil.relativedelta import relativedelta
 
-from codex_vitae.etl.api_requests import authenticate_gmail_api, get_email_content, get_rescuetime_daily
+import pytest
+
+from codex_vitae.etl.api_requests import authenticate_gmail_api, get_email_content, iter_email_content, get_rescuetime_daily, MessageCache
 
 
 def test_get_email_content():
@@ -30,6 +33,130 @@ def test_get_email_content():
     assert mynetdiary is None
 
 
+@pytest.mark.parametrize('multipart', [False, True])
+@pytest.mark.parametrize('batch_size', [50, 2, 0])
+def test_get_email_content_fake(gmail_service, multipart, batch_size):
+    """
+    GIVEN a fake GMail API service containing five emails,
+    WHEN get_email_content is called with and without batch requests,
+    THEN each email should be fetched once and returned in order.
+    """
+
+    bodies = [f'Sat, Jan {i},2022Mood: 5 Entry number {i}.' for i in range(1, 6)]
+    service = gmail_service(bodies, multipart=multipart)
+
+    emails = get_email_content(service, query='from:my@remarkable.com', batch_size=batch_size)
+
+    assert emails == bodies
+    assert service.calls['get'] == 5
+    assert service.calls['batch'] == (-(-5 // batch_size) if batch_size else 0)
+
+
+def test_iter_email_content_pages(gmail_service):
+    """
+    GIVEN a fake GMail API service containing more emails than fit on one page,
+    WHEN iter_email_content is called,
+    THEN every page should be followed and every email yielded lazily.
+    """
+
+    bodies = [f'Sat, Jan {i},2022Mood: 5 Entry number {i}.' for i in range(1, 12)]
+    service = gmail_service(bodies)
+
+    emails = iter_email_content(service, query='from:my@remarkable.com', page_size=5)
+
+    assert service.calls['list'] == 0
+    assert next(emails) == bodies[0]
+    assert service.calls['get'] == 5
+    assert len(list(emails)) == 10
+    assert service.calls['list'] == 3
+
+
+def test_get_email_content_empty(gmail_service):
+    """
+    GIVEN a fake GMail API service containing no emails,
+    WHEN get_email_content is called,
+    THEN None should be returned.
+    """
+
+    assert get_email_content(gmail_service([]), query='from:no-reply@mynetdiary.net') is None
+
+
+def test_message_cache(gmail_service, tmp_path):
+    """
+    GIVEN a fake GMail API service and an on-disk message cache,
+    WHEN the same query is run again before and after a new email arrives,
+    THEN only the new email should be downloaded and every email returned with its sent date.
+    """
+
+    bodies = [f'Sat, Jan {i},2022Mood: 5 Entry number {i}.' for i in range(1, 6)]
+    service = gmail_service(bodies)
+    cache = MessageCache(str(tmp_path / 'db'))
+
+    first = get_email_content(service, query='from:my@remarkable.com', cache=cache)
+    second = get_email_content(service, query='from:my@remarkable.com', cache=cache)
+
+    assert first == second
+    # Sent dates are kept with cached bodies.
+    assert [(email.id, email.sent) for email in second] == [(email.id, email.sent) for email in first]
+    assert {email.sent for email in second} == {date(2022, 1, 1)}
+    assert service.calls['get'] == 5
+    assert service.calls['list'] == 1
+
+    service.add_message('Thu, Jan 6,2022Mood: 4 Entry number 6.')
+    third = get_email_content(service, query='from:my@remarkable.com', cache=cache)
+
+    assert third == ['Thu, Jan 6,2022Mood: 4 Entry number 6.'] + first
+    assert service.calls['get'] == 6
+    assert service.calls['list'] == 2
+
+
+def test_message_cache_window(gmail_service, tmp_path):
+    """
+    GIVEN a message cache holding the listing of a query with a date window,
+    WHEN the window moves forward and mail not matching the query arrives,
+    THEN the listing should be reused, stored once, and narrowed to the new window.
+    """
+
+    bodies = [f'Sat, Jan {i},2022Mood: 5 Entry number {i}.' for i in range(1, 4)]
+    service = gmail_service(bodies)
+    cache = MessageCache(str(tmp_path / 'db'))
+
+    first = get_email_content(service, query='from:my@remarkable.com,after:2021-12-01', cache=cache)
+
+    service.add_message('Unrelated email.', sender='someone@example.com')
+    second = get_email_content(service, query='from:my@remarkable.com,after:2021-12-02', cache=cache)
+
+    assert second == first
+    assert service.calls['list'] == 2
+    assert service.calls['get'] == 3
+
+    # Every message was sent on 2022-01-01, before the new window.
+    assert get_email_content(service, query='from:my@remarkable.com,after:2022-01-05', cache=cache) is None
+    assert service.calls['list'] == 2
+
+    with closing(sqlite3.connect(str(tmp_path / 'db'))) as con:
+        assert con.execute("SELECT key FROM message_listing").fetchall() == [('from:my@remarkable.com',)]
+
+
+def test_message_cache_prune(gmail_service, tmp_path):
+    """
+    GIVEN a message cache with a listing older than the mailbox history is kept,
+    WHEN another query is listed,
+    THEN the expired listing should be deleted.
+    """
+
+    cache = MessageCache(str(tmp_path / 'db'))
+
+    with closing(sqlite3.connect(str(tmp_path / 'db'))) as con:
+        with con:
+            con.execute("INSERT INTO message_listing VALUES ('from:old@example.com', 'from:old@example.com', '1', '[]', 0)")
+
+    get_email_content(gmail_service(['Sat, Jan 1,2022Mood: 5 Entry.']), query='from:my@remarkable.com', cache=cache)
+
+    with closing(sqlite3.connect(str(tmp_path / 'db'))) as con:
+        assert con.execute("SELECT key FROM message_listing").fetchall() == [('from:my@remarkable.com',)]
+
+
 def test_get_rescuetime_daily():
     """
     GIVEN credentials to authenticate a RescueTime API session,
@@ -10,4 +10,351 @@ from datetime import date
 import datetime
 from dateutil.relativedelta import relativedelta
 
-from codex_vitae.etl.sqlite_module import db_prod, db_backup
\ No newline at end of file
+import gzip
+import json
+import sqlite3
+import time
+
+from codex_vitae.etl.sqlite_module import MIGRATIONS, TABLES, db_create, db_migrate, db_materialize, db_upsert, db_prod, db_backup, frame_rows, merge_backfill, PROD_TABLES
+
+
+_rescuetime = [('2022-01-01', 1.5, 2.0, 0.5),
+               ('2022-01-02', 3.0, 1.0, 0.25),
+               ]
+
+_remarkable = [(datetime.date(2022, 1, 1), 5.0, 'This is a sample journal entry for unit testing.'),
+               ]
+
+
+def test_db_prod(tmp_path):
+    """
+    GIVEN a newly created SQLite database and lists of production data tuples,
+    WHEN the tuples are bulk inserted with db_prod,
+    THEN the rows written to each table should be reported and the DB left in WAL mode.
+    """
+
+    db = str(tmp_path / 'db')
+    db_create(db)
+
+    row_counts = db_prod(db, [_rescuetime, _remarkable])
+
+    assert row_counts == {'rescuetime': 2, 'remarkable': 1}
+
+    with closing(sqlite3.connect(db)) as con:
+        assert con.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+        assert con.execute('select count(*) from rescuetime').fetchone()[0] == 2
+
+
+def test_db_migrate(tmp_path):
+    """
+    GIVEN a SQLite database containing production data,
+    WHEN db_create and db_migrate are called again,
+    THEN the schema version should be current and the existing rows should be kept.
+    """
+
+    db = str(tmp_path / 'db')
+    db_create(db)
+    db_prod(db, [_rescuetime])
+
+    db_create(db)
+
+    assert db_migrate(db) == len(MIGRATIONS)
+
+    with closing(sqlite3.connect(db)) as con:
+        assert con.execute('PRAGMA user_version').fetchone()[0] == len(MIGRATIONS)
+        assert con.execute('select count(*) from rescuetime').fetchone()[0] == 2
+
+
+def test_db_migrate_legacy(tmp_path):
+    """
+    GIVEN a SQLite database created with the original schema,
+    WHEN db_migrate is called,
+    THEN its tables should match a new database created from the table registry.
+    """
+
+    legacy = str(tmp_path / 'legacy')
+    fresh = str(tmp_path / 'fresh')
+
+    with closing(sqlite3.connect(legacy)) as con:
+        con.executescript(MIGRATIONS[0])
+
+    db_migrate(legacy)
+    db_migrate(fresh)
+
+    for table in TABLES:
+        with closing(sqlite3.connect(legacy)) as con:
+            legacy_info = con.execute(f'PRAGMA table_info({table})').fetchall()
+        with closing(sqlite3.connect(fresh)) as con:
+            fresh_info = con.execute(f'PRAGMA table_info({table})').fetchall()
+
+        assert legacy_info == fresh_info
+
+
+def test_db_prod_legacy(tmp_path):
+    """
+    GIVEN a SQLite database created with the original schema and holding production data,
+    WHEN db_prod is called without migrating the database first,
+    THEN the database should be migrated and the rows upserted.
+    """
+
+    db = str(tmp_path / 'db')
+
+    with closing(sqlite3.connect(db)) as con:
+        con.executescript(MIGRATIONS[0])
+        con.execute("INSERT INTO rescuetime VALUES ('2022-01-01', 1.0, 1.0, 1.0)")
+        con.commit()
+
+    db_prod(db, [_rescuetime, _remarkable])
+
+    with closing(sqlite3.connect(db)) as con:
+        assert con.execute('PRAGMA user_version').fetchone() == (len(MIGRATIONS),)
+        assert con.execute('select date, prd_hours, dst_hours, neut_hours from rescuetime order by date').fetchall() == _rescuetime
+
+
+@pytest.mark.parametrize('triggers', [True, False])
+def test_db_materialize(tmp_path, triggers):
+    """
+    GIVEN a SQLite database with materialized views,
+    WHEN production data is inserted with db_prod,
+    THEN the materialized tables should match the plain views.
+    """
+
+    db = str(tmp_path / 'db')
+    db_create(db)
+    db_materialize(db, triggers=triggers)
+    db_prod(db, [_rescuetime, _remarkable])
+
+    with closing(sqlite3.connect(db)) as con:
+        journal = con.execute('select * from journal_view order by date').fetchall()
+        rescuetime = con.execute('select * from rescuetime_view order by date').fetchall()
+        kind = con.execute("select type from sqlite_master where name = 'journal_view'").fetchone()[0]
+
+    db_materialize(db, materialize=False)
+
+    with closing(sqlite3.connect(db)) as con:
+        assert journal == con.execute('select * from journal_view order by date').fetchall()
+        assert rescuetime == con.execute('select * from rescuetime_view order by date').fetchall()
+
+    assert kind == 'table'
+    assert journal == [('2022-01-01', 0.0, 'This is a sample journal entry for unit testing.')]
+    assert len(rescuetime) == 2
+
+
+def test_db_materialize_triggers_incremental(tmp_path):
+    """
+    GIVEN a SQLite database with views materialized and kept current by triggers,
+    WHEN the trigger bodies are planned and loads of increasing size are upserted,
+    THEN every source should be searched by date and load time should grow linearly.
+    """
+
+    def load(n):
+        db = str(tmp_path / f'{n}.db')
+        db_create(db)
+        db_materialize(db)
+        rows = [(str(date(2000, 1, 1) + datetime.timedelta(days=i)), 5.0, 'entry') for i in range(n)]
+
+        start = time.perf_counter()
+        db_upsert(db, [('remarkable', ['date', 'mood', 'entry'])], [rows])
+
+        return db, time.perf_counter() - start
+
+    db, small = load(500)
+
+    with closing(sqlite3.connect(db)) as con:
+        triggers = con.execute("select sql from sqlite_master where type = 'trigger'").fetchall()
+
+        for (sql,) in triggers:
+            body = sql[sql.index('BEGIN') + len('BEGIN'):sql.rindex('END')]
+
+            for statement in filter(str.strip, body.split(';')):
+                statement = statement.replace('NEW.date', "'2000-01-01'").replace('OLD.date', "'2000-01-01'")
+                plan = [row[-1] for row in con.execute(f"EXPLAIN QUERY PLAN {statement}")]
+
+                assert not [step for step in plan if step.startswith('SCAN') and 'subquery' not in step]
+
+        assert con.execute('select count(*) from journal_view').fetchone()[0] == 500
+
+    _, large = load(2000)
+
+    # Refreshing every view over every row on each trigger fire would take about 16 times as long.
+    assert large < 8 * small
+
+
+@pytest.mark.parametrize('fmt', ['jsonl', 'parquet', 'sqlite'])
+def test_db_backup(tmp_path, fmt):
+    """
+    GIVEN a SQLite database containing production data,
+    WHEN db_backup is called for each backup format,
+    THEN backup files should be written containing every row.
+    """
+
+    if fmt == 'parquet':
+        pytest.importorskip('pyarrow')
+
+    db = str(tmp_path / 'db')
+    db_create(db)
+    db_prod(db, [_rescuetime, _remarkable])
+    db_upsert(db, [('bullet_journal', ['date', 'mood', 'sleep', 'steps', 'cardio', 'mood_note'])],
+              [[('2021-01-01', 4, 7.5, '10,000', 1, 'note'), ('2021-01-02', 5, 8, 8000, 0, None)]])
+
+    backup_files = db_backup(db, backup_dir=str(tmp_path / 'backup'), fmt=fmt, batch_size=1)
+
+    if fmt == 'sqlite':
+        with closing(sqlite3.connect(backup_files[0])) as con:
+            assert con.execute('select count(*) from rescuetime_view').fetchone()[0] == 2
+
+    elif fmt == 'jsonl':
+        assert len(backup_files) == 12
+
+        with gzip.open(tmp_path / 'backup' / 'rescuetime.jsonl.gz', 'rt') as f:
+            rows = [json.loads(line) for line in f]
+
+        assert rows[0] == {'date': '2022-01-01', 'prd_hours': 1.5, 'dst_hours': 2.0, 'neut_hours': 0.5}
+        assert len(rows) == 2
+
+    else:
+        import pyarrow.parquet as pq
+
+        assert pq.read_table(tmp_path / 'backup' / 'journal_view.parquet').num_rows == 3
+        assert pq.read_table(tmp_path / 'backup' / 'rescuetime.parquet').to_pylist() == [
+            dict(zip(['date', 'prd_hours', 'dst_hours', 'neut_hours'], row)) for row in _rescuetime]
+
+        # Values that do not match the declared column type are kept as stored.
+        assert pq.read_table(tmp_path / 'backup' / 'bullet_journal.parquet').to_pylist() == [
+            {'date': '2021-01-01', 'mood': 4.0, 'sleep': 7.5, 'steps': '10,000', 'cardio': 1, 'meditate': None,
+             'mood_note': 'note', 'fasting': None, 'cheat_meals': None, 'read': None, 'draw': None,
+             'learn': None, 'write': None, 'guitar': None},
+            {'date': '2021-01-02', 'mood': 5.0, 'sleep': 8.0, 'steps': '8000', 'cardio': 0, 'meditate': None,
+             'mood_note': None, 'fasting': None, 'cheat_meals': None, 'read': None, 'draw': None,
+             'learn': None, 'write': None, 'guitar': None}]
+
+
+def test_db_upsert(tmp_path):
+    """
+    GIVEN a SQLite database containing production data,
+    WHEN the same rows are loaded again alongside a partial update of one row,
+    THEN only the changed row should be written and its other columns kept.
+    """
+
+    db = str(tmp_path / 'db')
+    db_create(db)
+    db_prod(db, [_rescuetime, _remarkable])
+
+    row_counts = db_upsert(db,
+                           [('rescuetime', ['date', 'prd_hours', 'dst_hours', 'neut_hours']),
+                            ('remarkable', ['mood', 'entry', 'date']),
+                            ],
+                           [_rescuetime,
+                            [(4.0, 'An updated journal entry.', datetime.date(2022, 1, 1))],
+                            ])
+
+    assert row_counts == {'rescuetime': 0, 'remarkable': 1}
+
+    with closing(sqlite3.connect(db)) as con:
+        assert con.execute('select date, mood, entry from remarkable').fetchall() == [
+            ('2022-01-01', 4.0, 'An updated journal entry.')]
+
+
+def test_merge_backfill(tmp_path):
+    """
+    GIVEN production rows and backfills whose values differ from them,
+    WHEN the backfills are merged into the production rows and loaded repeatedly,
+    THEN each date should be written once, journal backfills should replace production
+        values, RescueTime API data should win, and identical reloads should write nothing.
+    """
+
+    db = str(tmp_path / 'db')
+    db_create(db)
+    columns = dict(PROD_TABLES)
+
+    # A RescueTime row from an earlier run, which the API no longer returns.
+    db_upsert(db, [('rescuetime', columns['rescuetime'])], [[('2021-12-31', 4.0, 1.0, 1.0)]])
+
+    def load():
+        remarkable, journal_leftover = merge_backfill(
+            columns['remarkable'], _remarkable, ['mood', 'entry', 'date'],
+            [(7.0, 'Corrected entry.', '2022-01-01'), (6.0, 'Missing entry.', '2022-01-03')])
+        rescuetime, rt_leftover = merge_backfill(
+            columns['rescuetime'], _rescuetime, ['date', 'prd_hours', 'dst_hours', 'neut_hours'],
+            [('2021-12-31', 0.0, 0.0, 0.0), ('2022-01-01', 9.0, 9.0, 9.0)], keep_existing=True)
+
+        assert journal_leftover == [(6.0, 'Missing entry.', '2022-01-03')]
+        assert rt_leftover == [('2021-12-31', 0.0, 0.0, 0.0)]
+
+        return db_upsert(db, [('rescuetime', columns['rescuetime']),
+                              ('remarkable', columns['remarkable']),
+                              ('remarkable', ['mood', 'entry', 'date']),
+                              ('rescuetime', ['date', 'prd_hours', 'dst_hours', 'neut_hours'], True),
+                              ], [rescuetime, remarkable, journal_leftover, rt_leftover])
+
+    assert load() == {'rescuetime': 2, 'remarkable': 2}
+    assert load() == {'rescuetime': 0, 'remarkable': 0}
+
+    with closing(sqlite3.connect(db)) as con:
+        assert con.execute('select date, mood, entry from remarkable order by date').fetchall() == [
+            ('2022-01-01', 7.0, 'Corrected entry.'), ('2022-01-03', 6.0, 'Missing entry.')]
+        assert con.execute('select date, prd_hours from rescuetime order by date').fetchall() == [
+            ('2021-12-31', 4.0), ('2022-01-01', 1.5), ('2022-01-02', 3.0)]
+
+
+def test_db_upsert_frame(tmp_path):
+    """
+    GIVEN a SQLite database and a Pandas DataFrame of Exist time data with missing values,
+    WHEN the DataFrame is upserted directly,
+    THEN its rows should be streamed in batches with missing values stored as NULL.
+    """
+
+    pd = pytest.importorskip('pandas')
+
+    df = pd.DataFrame({'prd_mins': [60.0, float('nan'), 30.0],
+                       'date': ['2022-01-01', '2022-01-02', '2022-01-03'],
+                       'dst_mins': [5, 10, 15],
+                       'neut_mins': [None, 1.0, 2.0],
+                       })
+
+    assert list(frame_rows(df, batch_size=2)) == [(60.0, '2022-01-01', 5, None),
+                                                  (None, '2022-01-02', 10, 1.0),
+                                                  (30.0, '2022-01-03', 15, 2.0)]
+
+    db = str(tmp_path / 'db')
+    db_create(db)
+    row_counts = db_upsert(db, [('exist_time', list(df.columns))], [df])
+
+    assert row_counts == {'exist_time': 3}
+
+    with closing(sqlite3.connect(db)) as con:
+        assert con.execute('select prd_mins, date, dst_mins, neut_mins from exist_time order by date').fetchall() == [
+            (60.0, '2022-01-01', 5.0, None), (None, '2022-01-02', 10.0, 1.0), (30.0, '2022-01-03', 15.0, 2.0)]
+
+
+def test_db_upsert_backfill(tmp_path):
+    """
+    GIVEN production data and backfills supplying a subset of the columns of the same rows,
+    WHEN both are upserted together repeatedly with identical data,
+    THEN only the first load should write rows.
+    """
+
+    db = str(tmp_path / 'db')
+    db_create(db)
+
+    table_list = [('rescuetime', ['date', 'prd_hours', 'dst_hours', 'neut_hours']),
+                  ('remarkable', ['date', 'mood', 'entry']),
+                  ('remarkable', ['mood', 'entry', 'date']),
+                  ('fitness', [col for col, _ in TABLES['fitness']]),
+                  ('fitness', ['pulse', 'sleep', 'date']),
+                  ]
+
+    def load():
+        return db_upsert(db, table_list, [_rescuetime,
+                                          _remarkable,
+                                          [(5.0, 'This is a sample journal entry for unit testing.', '2022-01-01')],
+                                          [('05/10/21', 170.0, 1739.0, 67, 6.8, 0.6, 4.2, 2.0, 0.2, 5873, 2392)],
+                                          [(67, 6.8, '05/10/21')],
+                                          ])
+
+    assert load() == {'rescuetime': 2, 'remarkable': 2, 'fitness': 2}
+    assert load() == {'rescuetime': 0, 'remarkable': 0, 'fitness': 0}
+    assert load() == {'rescuetime': 0, 'remarkable': 0, 'fitness': 0}
+
+    with closing(sqlite3.connect(db)) as con:
+        assert con.execute('select count(*) from fitness where row_hash is null').fetchone() == (0,)
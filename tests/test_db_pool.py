@@ -0,0 +1,82 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import pytest
+
+import sqlalchemy
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import QueuePool
+
+from etl.db_pool import POOL_PROFILES, PoolMetrics, pool_metrics
+from etl.orm_inserts import get_engine
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'pool.db'}", poolclass=QueuePool,
+                           pool_size=1, max_overflow=1, pool_timeout=0.1)
+    yield engine
+    engine.dispose()
+
+
+def test_pool_metrics(engine):
+    """
+    GIVEN an instrumented QueuePool engine,
+    WHEN connections are checked out through PoolMetrics.connect, one of them beyond pool_size,
+    THEN checkouts, checkins, overflow use and connection waits should be recorded.
+    """
+
+    metrics = PoolMetrics(engine)
+
+    with metrics.connect() as first, metrics.connect() as second:
+        first.execute(text("select 1"))
+        second.execute(text("select 1"))
+
+    snapshot = metrics.snapshot()
+
+    assert snapshot['checkouts'] == 2
+    assert snapshot['checkins'] == 2
+    assert snapshot['checked_out'] == 0
+    assert snapshot['overflow_checkouts'] == 1
+    assert snapshot['max_overflow_used'] == 1
+    assert snapshot['timeouts'] == 0
+    assert snapshot['mean_wait_seconds'] > 0
+
+
+def test_pool_metrics_timeout(engine):
+    """
+    GIVEN an instrumented QueuePool engine with every connection checked out,
+    WHEN another connection is requested through PoolMetrics.connect,
+    THEN the pool timeout should be raised and counted.
+    """
+
+    metrics = pool_metrics(engine)
+
+    assert pool_metrics(engine) is metrics
+
+    with metrics.connect(), metrics.connect():
+        with pytest.raises(sqlalchemy.exc.TimeoutError):
+            with metrics.connect():
+                pass
+
+    assert metrics.snapshot()['timeouts'] == 1
+    assert metrics.snapshot()['checkouts'] == 2
+
+
+def test_get_engine_profiles(tmp_path):
+    """
+    GIVEN a database URL,
+    WHEN engines are requested for several pool profiles,
+    THEN each profile should get its own pool with its settings, shared by later requests.
+    """
+
+    url = f"sqlite:///{tmp_path / 'profiles.db'}"
+
+    web = get_engine(url, **POOL_PROFILES['web'])
+    etl = get_engine(url, **POOL_PROFILES['etl'])
+
+    assert web is not etl
+    assert get_engine(url, **POOL_PROFILES['web']) is web
+    assert (web.pool.size(), etl.pool.size()) == (POOL_PROFILES['web']['pool_size'], POOL_PROFILES['etl']['pool_size'])
+    assert etl.pool.timeout() == POOL_PROFILES['etl']['pool_timeout']
@@ -0,0 +1,201 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import datetime
+
+import pytest
+
+from sqlalchemy import create_engine, event, select, text
+
+from etl.sqlite_module import db_create, db_upsert, db_prod
+from etl import orm_inserts
+from etl.orm_models import JournalProd, RescueTimeProd, ExistJournal, reMarkable
+from etl.orm_inserts import bulk_load_csv, upsert_statement, sync_view, sync_prod, load_table, insert_exist_journal, insert_remarkable, insert_rescuetime_prod
+
+
+_rescuetime = [('2022-01-01', 1.5, 2.0, 0.5),
+               ('2022-01-02', 3.0, 1.0, 0.25),
+               ]
+
+_remarkable = [('2022-01-01', 5.0, 'This is a sample journal entry for unit testing.'),
+               ]
+
+
+@pytest.fixture
+def sqlite_db(tmp_path):
+    db = str(tmp_path / 'db')
+    db_create(db)
+    db_prod(db, [_rescuetime, _remarkable])
+
+    return db
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'target.db'}")
+    yield engine
+    engine.dispose()
+
+
+def test_bulk_load_csv(tmp_path, engine):
+    """
+    GIVEN a CSV file with headers in mixed case, one renamed, empty fields and timestamped dates,
+    WHEN it is loaded with bulk_load_csv in batches of two rows,
+    THEN every row should be loaded in three round trips with matched columns, NULLs and dates.
+    """
+
+    csv_path = tmp_path / 'exist_journal.csv'
+    csv_path.write_text('MOOD,Date,Mood_Note,Unused\n'
+                        '7,2022-01-01 00:00:00,First entry.,x\n'
+                        ',2022-01-02,Second entry.,x\n'
+                        '8,2022-01-03,,x\n'
+                        '9,2022-01-04,Fourth entry.,\n'
+                        '6,2022-01-05,Fifth entry.,x\n')
+
+    batches = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def count_rows(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT'):
+            batches.append(len(parameters) if executemany else 1)
+
+    assert bulk_load_csv(ExistJournal, str(csv_path), rename={'MOOD_NOTE': 'entry'}, batch_size=2, engine=engine) == 5
+    assert batches == [2, 2, 1]
+
+    with engine.connect() as con:
+        table = ExistJournal.__table__
+        rows = con.execute(select(table.c.date, table.c.mood, table.c.entry).order_by(table.c.date)).all()
+
+    assert rows == [(datetime.date(2022, 1, 1), 7.0, 'First entry.'),
+                    (datetime.date(2022, 1, 2), None, 'Second entry.'),
+                    (datetime.date(2022, 1, 3), 8.0, None),
+                    (datetime.date(2022, 1, 4), 9.0, 'Fourth entry.'),
+                    (datetime.date(2022, 1, 5), 6.0, 'Fifth entry.')]
+
+
+def test_upsert_statement(engine):
+    """
+    GIVEN a SQLite target engine and a production table,
+    WHEN rows are written twice with upsert_statement,
+    THEN the second write should update the existing rows instead of failing.
+    """
+
+    table = RescueTimeProd.__table__
+    table.create(engine)
+    row = {'date': datetime.date(2022, 1, 1), 'prd_hours': 1.0, 'dst_hours': 2.0, 'neut_hours': 0.5, 'row_hash': None}
+
+    with engine.begin() as con:
+        con.execute(upsert_statement(engine, table), [row])
+        con.execute(upsert_statement(engine, table), [{**row, 'prd_hours': 4.0}])
+
+    with engine.connect() as con:
+        assert con.execute(select(table.c.date, table.c.prd_hours)).all() == [(datetime.date(2022, 1, 1), 4.0)]
+
+
+def test_sync_prod(sqlite_db, engine):
+    """
+    GIVEN a SQLite database with production data and an empty target database,
+    WHEN sync_prod is run twice,
+    THEN every row should be copied once and the second run should send nothing.
+    """
+
+    assert sync_prod(sqlite_db, engine=engine) == {'journal_prod': 1, 'rescuetime_prod': 2}
+    assert sync_prod(sqlite_db, engine=engine) == {'journal_prod': 0, 'rescuetime_prod': 0}
+
+    with engine.connect() as con:
+        rows = con.execute(select(RescueTimeProd.__table__.c.date, RescueTimeProd.__table__.c.prd_hours)).all()
+
+    assert rows == [(datetime.date(2022, 1, 1), 1.5), (datetime.date(2022, 1, 2), 3.0)]
+
+
+def test_sync_view_backfill(sqlite_db, engine):
+    """
+    GIVEN a target database already synced from SQLite,
+    WHEN a row older than the latest synced date is corrected and the view synced again,
+    THEN only the corrected row should be sent and the target should hold its new values.
+    """
+
+    sync_view(RescueTimeProd, 'rescuetime_view', sqlite_db, engine=engine)
+    db_upsert(sqlite_db, [('rescuetime', ['date', 'prd_hours', 'dst_hours', 'neut_hours'])],
+              [[('2022-01-01', 6.0, 2.0, 0.5)]])
+
+    assert sync_view(RescueTimeProd, 'rescuetime_view', sqlite_db, engine=engine) == 1
+
+    with engine.connect() as con:
+        prd_hours = con.execute(select(RescueTimeProd.__table__.c.prd_hours)
+                                .where(RescueTimeProd.__table__.c.date == datetime.date(2022, 1, 1))).scalar()
+
+    assert prd_hours == 6.0
+
+
+def test_sync_view_precedence(sqlite_db, engine):
+    """
+    GIVEN a date with journal entries from both Exist and reMarkable,
+    WHEN journal_view is synced,
+    THEN the reMarkable entry should be kept, however often the sync runs.
+    """
+
+    db_upsert(sqlite_db, [('exist_journal', ['mood', 'date', 'entry'])], [[(9.0, '2022-01-01', 'Exist entry.')]])
+
+    assert sync_view(JournalProd, 'journal_view', sqlite_db, engine=engine) == 1
+    assert sync_view(JournalProd, 'journal_view', sqlite_db, engine=engine) == 0
+
+    with engine.connect() as con:
+        assert con.execute(select(JournalProd.__table__.c.entry)).scalars().all() == [_remarkable[0][2]]
+
+
+def test_sync_view_legacy_target(sqlite_db, engine):
+    """
+    GIVEN a target table created before synced rows were hashed,
+    WHEN the view is synced,
+    THEN the row_hash column should be added and every row sent once.
+    """
+
+    with engine.begin() as con:
+        con.execute(text("CREATE TABLE rescuetime_prod (date DATE PRIMARY KEY, prd_hours FLOAT, dst_hours FLOAT, neut_hours FLOAT)"))
+
+    assert sync_view(RescueTimeProd, 'rescuetime_view', sqlite_db, engine=engine) == 2
+    assert sync_view(RescueTimeProd, 'rescuetime_view', sqlite_db, engine=engine) == 0
+
+
+def test_load_table_sqlite(sqlite_db, engine, monkeypatch):
+    """
+    GIVEN a SQLite database set by DB_PATH or passed explicitly,
+    WHEN tables are loaded with load_table and the insert wrappers, twice,
+    THEN rows should be synced from SQLite and the second load should send nothing.
+    """
+
+    monkeypatch.setenv('DB_PATH', sqlite_db)
+
+    assert insert_remarkable(engine=engine) == 1
+    assert insert_rescuetime_prod(engine=engine, sqlite_path=sqlite_db) == 2
+    assert load_table(reMarkable, 'remarkable', 'remarkable', engine=engine) == 0
+
+    with engine.connect() as con:
+        assert con.execute(select(reMarkable.__table__.c.date, reMarkable.__table__.c.mood)).all() == [
+            (datetime.date(2022, 1, 1), 5.0)]
+
+
+def test_load_table_csv(tmp_path, engine, monkeypatch):
+    """
+    GIVEN a CSV export in APP_DIR and no SQLite database,
+    WHEN a table is loaded with an insert wrapper twice,
+    THEN the CSV rows should be loaded with renamed headers, and reloading should update rather than fail.
+    """
+
+    monkeypatch.delenv('DB_PATH', raising=False)
+    monkeypatch.setattr(orm_inserts, 'DIR', str(tmp_path))
+
+    (tmp_path / 'exist_journal.csv').write_text('mood,date,mood_note\n7,2022-01-01,First entry.\n8,2022-01-02,\n')
+
+    assert insert_exist_journal(engine=engine) == 2
+
+    (tmp_path / 'exist_journal.csv').write_text('mood,date,mood_note\n9,2022-01-01,Edited entry.\n8,2022-01-02,\n')
+
+    assert insert_exist_journal(engine=engine) == 2
+
+    with engine.connect() as con:
+        table = ExistJournal.__table__
+        assert con.execute(select(table.c.date, table.c.mood, table.c.entry).order_by(table.c.date)).all() == [
+            (datetime.date(2022, 1, 1), 9.0, 'Edited entry.'), (datetime.date(2022, 1, 2), 8.0, None)]
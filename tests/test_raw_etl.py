@@ -0,0 +1,128 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import numpy as np
+import pytest
+
+import raw_etl
+from raw_etl import json_to_df, exist_years, exist_dataframes
+
+
+_TAGS = ['alcohol', 'bedsheets', 'cardio', 'cleaning', 'dating', 'drawing', 'eating_out', 'fasting', 'guitar',
+         'laundry', 'learning', 'meal_prep', 'meditation', 'nap', 'nutribullet', 'piano', 'reading', 'shopping',
+         'tech', 'travel', 'tv', 'walk', 'writing']
+
+_VARIABLES = _TAGS + ['mood', 'mood_note', 'productive_min', 'distracting_min', 'neutral_min',
+                      'active_energy', 'heartrate', 'heartrate_max', 'heartrate_resting', 'steps',
+                      'weight', 'sleep', 'sleep_end', 'sleep_start']
+
+
+def _write(directory, var, year, records):
+    (directory / f'data_{var}_{year}.json').write_text(json.dumps(
+        [{'date': date, 'value': value} for date, value in records]))
+
+
+@pytest.fixture
+def extract(tmp_path):
+    """Write an Exist extract with unreadable files for a year before the default cutoff."""
+
+    directory = tmp_path / 'exist_full_extract'
+    directory.mkdir()
+
+    for var in _VARIABLES:
+        # Opening any 2019 file would fail to parse.
+        (directory / f'data_{var}_2019.json').write_text('not json')
+        _write(directory, var, 2020, [('2020-04-05', 1), ('2020-12-31', 2)])
+        _write(directory, var, 2021, [('2021-01-01', 3)])
+
+    (directory / 'README.txt').write_text('Not a data file.')
+
+    return tmp_path
+
+
+def test_json_to_df(tmp_path):
+    """
+    GIVEN Exist json files of one year whose dates only partly overlap,
+    WHEN they are read with json_to_df,
+    THEN the values should be aligned on the union of dates with the first variable leading the columns.
+    """
+
+    _write(tmp_path, 'mood', 2021, [('2021-01-01', 5), ('2021-01-02', 6)])
+    _write(tmp_path, 'mood_note', 2021, [('2021-01-02', 'Note.'), ('2021-01-03', 'Later note.')])
+
+    df = json_to_df(['mood', 'mood_note'], '2021', directory=str(tmp_path))
+
+    assert list(df.columns) == ['mood', 'date', 'mood_note']
+    assert df['date'].tolist() == ['2021-01-01', '2021-01-02', '2021-01-03']
+    assert df['mood'].tolist()[:2] == [5, 6] and np.isnan(df['mood'].tolist()[2])
+    assert df['mood_note'].tolist()[1:] == ['Note.', 'Later note.'] and df['mood_note'].isna().tolist()[0]
+
+    # Records on or before the cutoff are dropped.
+    df = json_to_df(['mood', 'mood_note'], '2021', directory=str(tmp_path), cutoff='2021-01-02')
+
+    assert df['date'].tolist() == ['2021-01-03']
+    assert df['mood'].isna().all()
+    assert df['mood_note'].tolist() == ['Later note.']
+
+
+def test_json_to_df_loads(tmp_path, monkeypatch):
+    """
+    GIVEN Exist json files and a custom loads function,
+    WHEN json_to_df is called with and without the loads hook,
+    THEN files should be read through the hook, or through the module's json reader (orjson when installed).
+    """
+
+    _write(tmp_path, 'mood', 2021, [('2021-01-01', 5)])
+
+    paths = []
+
+    def loads(path):
+        paths.append(path)
+        return [{'date': '2021-01-01', 'value': 9}]
+
+    assert json_to_df(['mood'], '2021', loads=loads, directory=str(tmp_path))['mood'].tolist() == [9]
+    assert paths == [str(tmp_path / 'data_mood_2021.json')]
+
+    contents = []
+    monkeypatch.setattr(raw_etl, '_json_loads', lambda data: contents.append(data) or json.loads(data))
+
+    assert json_to_df(['mood'], '2021', directory=str(tmp_path))['mood'].tolist() == [5]
+    assert isinstance(contents[0], bytes)
+
+
+def test_exist_years(extract):
+    """
+    GIVEN an Exist extract with files for several years and unrelated files,
+    WHEN exist_years is called with and without a cutoff,
+    THEN the years should be found from the file names, leaving out years ending before the cutoff.
+    """
+
+    directory = str(extract / 'exist_full_extract')
+
+    assert exist_years(directory) == ['2019', '2020', '2021']
+    assert exist_years(directory, cutoff='2020-04-06') == ['2020', '2021']
+    assert exist_years(directory, cutoff='2020-12-31') == ['2021']
+
+
+def test_exist_dataframes(extract):
+    """
+    GIVEN an Exist extract whose files before the cutoff year cannot be parsed,
+    WHEN exist_dataframes is called with the default cutoff,
+    THEN years before the cutoff should never be opened, and each table should stack its years in date order.
+    """
+
+    tags, journal, productivity, fitness = exist_dataframes(str(extract), max_workers=2)
+
+    assert list(tags.columns) == ['alcohol', 'date'] + _TAGS[1:]
+    assert list(journal.columns) == ['mood', 'date', 'mood_note']
+    assert list(productivity.columns) == ['productive_min', 'date', 'distracting_min', 'neutral_min']
+    assert list(fitness.columns)[:2] == ['active_energy', 'date']
+
+    # 2020-04-05 is on or before the cutoff.
+    for df in (tags, journal, productivity, fitness):
+        assert df['date'].tolist() == ['2020-12-31', '2021-01-01']
+
+    assert journal['mood'].tolist() == [2, 3]
@@ -3,10 +3,15 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import ast
+import sqlite3
 import pytest
 import datetime
 
-from codex_vitae.etl.text_processing import reMarkableParsing, fitness_parsing, nutrition_parsing
+from contextlib import closing
+
+from codex_vitae.etl.api_requests import EmailBody
+from codex_vitae.etl.text_processing import reMarkableParsing, fitness_parsing, nutrition_parsing, mynetdiary_parsing, mynetdiary_rows, mynetdiary_columns, parallel_parse, parse_date, report_date, ParseCache, PARSER_VERSIONS
 
 
 with open('tests/test_remarkable.txt', 'r') as f:
@@ -15,6 +20,14 @@ with open('tests/test_remarkable.txt', 'r') as f:
 with open('tests/test_mynetdiary.txt', 'r') as f:
         _mynetdiary = f.read()
 
+# The same emails as UTF-8 decoded text rather than bytes reprs.
+_remarkable_decoded = ("<!DOCTYPE HTML PUBLIC>\r\n<html><head><style>p, li { white-space: pre-wrap; }</style></head>"
+                       "<body>Sat, Jan 1,2022\r\n<p>Mood: 5 </p>This is a sample journal entry for unit testing. </p></body>"
+                       "--<br>Sent from my reMarkable paper tablet<br>Get yours at www.remarkable.com<br><br>"
+                       "PS: You cannot reply to this email<br>\r\n")
+
+_mynetdiary_decoded = ast.literal_eval(_mynetdiary).decode('utf-8')
+
 def test_remarkable(remarkable=_remarkable):
     """
     GIVEN An example of a raw reMarkable email body retrieved via the GMail API and variations of cleaned email text,
@@ -52,6 +65,24 @@ def test_remarkable(remarkable=_remarkable):
     
     assert tuple_ == processed
 
+@pytest.mark.parametrize('email_', [
+    'Your export is ready: notebook.pdf',
+    'Sat, Jan 1,2022Mood: great day',
+    'Not a dateMood: 5 This entry has no date.',
+])
+def test_remarkable_skips_non_journal(email_, caplog):
+    """
+    GIVEN emails containing colons that are not dated journal entries with a mood rating,
+    WHEN they are parsed along with a journal entry,
+    THEN they should be skipped and logged instead of raising.
+    """
+
+    assert reMarkableParsing().parse(email_) is None
+    assert reMarkableParsing().run([email_, _remarkable]) == [
+        (datetime.date(2022, 1, 1), 5.0, 'This is a sample journal entry for unit testing.')]
+    assert 'Skipping email without a journal entry' in caplog.text
+
+
 def test_fitness(mynetdiary=_mynetdiary):
     """
     GIVEN an example of a raw MyNetDiary email body retrieved via the GMail API,
@@ -73,4 +104,178 @@ def test_nutrition(mynetdiary=_mynetdiary):
 
     _nutrition = nutrition_parsing([mynetdiary])
 
-    assert len(_nutrition) == 5
\ No newline at end of file
+    assert len(_nutrition) == 5
+
+
+def test_mynetdiary_parsing(mynetdiary=_mynetdiary):
+    """
+    GIVEN an example of a raw MyNetDiary email body retrieved via the GMail API,
+    WHEN the mynetdiary_parsing method is called,
+    THEN fitness and nutrition rows should be scanned from the same email with numeric values.
+    """
+
+    _fitness, _nutrition = mynetdiary_parsing([mynetdiary])
+
+    assert repr(_fitness) == repr(fitness_parsing([mynetdiary]))
+    assert _fitness[0] == ('05/10/21', 170, 1739, 67, 6.8, 0.6, 4.2, 6.8 - 0.6 - 4.2, 0.2, 5873, 2392)
+    assert _nutrition[0][1:] == (2576, 120, 180, 136, 20, 1632, 128)
+    assert [day.strftime('%m%d') for day, *_ in _nutrition] == ['0510', '0511', '0512', '0513', '0516']
+
+
+def test_mynetdiary_parsing_frame(mynetdiary=_mynetdiary):
+    """
+    GIVEN an example of a raw MyNetDiary email body retrieved via the GMail API,
+    WHEN the mynetdiary_parsing method is called with as_frame,
+    THEN single DataFrames should be returned with the same values as the tuples.
+    """
+
+    _fitness, _nutrition = mynetdiary_parsing([mynetdiary, mynetdiary], as_frame=True)
+
+    assert list(_fitness.columns) == ['date', 'weight', 'bmr', 'pulse', 'sleep', 'deep_sleep', 'light_sleep',
+                                      'rem_sleep', 'awakes', 'daily_steps', 'calories_out']
+    assert len(_fitness) == 14
+    assert len(_nutrition) == 10
+    assert repr(list(_fitness.itertuples(index=False, name=None))[:7]) == repr(fitness_parsing([mynetdiary]))
+
+
+@pytest.mark.parametrize("min_emails", [2, 100])
+def test_parallel_parse(min_emails, remarkable=_remarkable, mynetdiary=_mynetdiary):
+    """
+    GIVEN raw reMarkable and MyNetDiary emails,
+    WHEN they are parsed by parallel_parse in worker processes or serially,
+    THEN the results should match parsing them in a single call, in the same order.
+    """
+
+    _fitness, _nutrition = parallel_parse(mynetdiary_parsing, iter([mynetdiary, _mynetdiary_decoded, mynetdiary]),
+                                          chunk_size=1, max_workers=2, min_emails=min_emails)
+
+    assert repr((_fitness, _nutrition)) == repr(mynetdiary_parsing([mynetdiary] * 3))
+
+    _remarkable_list = [remarkable, _remarkable_decoded, remarkable]
+
+    assert parallel_parse(reMarkableParsing().run, _remarkable_list, chunk_size=1, max_workers=2,
+                          min_emails=min_emails) == reMarkableParsing().run(_remarkable_list)
+
+
+def test_decoded_emails():
+    """
+    GIVEN examples of raw reMarkable and MyNetDiary emails as UTF-8 decoded text,
+    WHEN they are parsed,
+    THEN the results should match parsing the same emails as bytes reprs.
+    """
+
+    assert reMarkableParsing().clean_emails(_remarkable_decoded) == reMarkableParsing().clean_emails(_remarkable)
+    assert reMarkableParsing().run([_remarkable_decoded]) == reMarkableParsing().run([_remarkable])
+    # Compare reprs, since missing values are NaN and NaN != NaN.
+    assert repr(fitness_parsing([_mynetdiary_decoded])) == repr(fitness_parsing([_mynetdiary]))
+    assert repr(nutrition_parsing([_mynetdiary_decoded])) == repr(nutrition_parsing([_mynetdiary]))
+
+
+def test_remarkable_iter_run(remarkable=_remarkable):
+    """
+    GIVEN a stream of raw reMarkable emails including a PDF attachment and a non-journal email,
+    WHEN the iter_run method is called,
+    THEN a journal tuple should be yielded lazily for each email containing an entry.
+    """
+
+    emails = iter([remarkable, "b'6\\x89\\xde'", 'No entry in this email.', _remarkable_decoded])
+    journals = reMarkableParsing().iter_run(emails)
+
+    assert next(journals) == (datetime.date(2022, 1, 1), 5.0, 'This is a sample journal entry for unit testing.')
+    assert len(list(journals)) == 1
+
+
+@pytest.mark.parametrize('text, default_year, expected', [
+    ('Sat, Jan 1,2022', None, datetime.date(2022, 1, 1)),
+    (' Sat, Jan 1, 2022 ', None, datetime.date(2022, 1, 1)),
+    ('Monday, May 10', 2021, datetime.date(2021, 5, 10)),
+    ('Tuesday, February 29', 2024, datetime.date(2024, 2, 29)),
+    ('2022-01-01', None, datetime.date(2022, 1, 1)),
+])
+def test_parse_date(text, default_year, expected):
+    """
+    GIVEN date strings in known and unknown formats,
+    WHEN parse_date is called,
+    THEN the returned date should match the expected date.
+    """
+
+    assert parse_date(text, default_year) == expected
+
+
+@pytest.mark.parametrize("text, sent, expected", [
+    ('Monday, May 10', datetime.date(2021, 5, 17), datetime.date(2021, 5, 10)),
+    ('Thursday, December 30', datetime.date(2022, 1, 2), datetime.date(2021, 12, 30)),
+    ('Sunday, January 2', datetime.date(2022, 1, 2), datetime.date(2022, 1, 2)),
+])
+def test_report_date(text, sent, expected):
+    """
+    GIVEN MyNetDiary report days without years and the dates their emails were sent,
+    WHEN report_date is called,
+    THEN days after the sent date should fall in the previous year.
+    """
+
+    assert report_date(text, sent) == expected
+
+
+def test_nutrition_sent_date(mynetdiary=_mynetdiary):
+    """
+    GIVEN a MyNetDiary email carrying the timestamp it was sent on 05/17/21,
+    WHEN the nutrition_parsing method is called,
+    THEN the dates should be in 2021 regardless of the current date.
+    """
+
+    # 2021-05-17 12:00 UTC in milliseconds.
+    email_ = EmailBody(_mynetdiary_decoded, 'id', 1621252800000)
+
+    assert email_.sent == datetime.date(2021, 5, 17)
+    assert [day for day, *_ in nutrition_parsing([email_])] == [datetime.date(2021, 5, d) for d in (10, 11, 12, 13, 16)]
+
+
+def test_parse_cache(tmp_path, monkeypatch, remarkable=_remarkable, mynetdiary=_mynetdiary):
+    """
+    GIVEN an on-disk parse cache,
+    WHEN the same emails are parsed again, after a parser version bump, and beyond the size limit,
+    THEN only emails without current cached results should be parsed, and old results evicted.
+    """
+
+    calls = []
+    batches = []
+
+    def parser(emails):
+        calls.extend(emails)
+        return mynetdiary_rows(emails)
+
+    def assemble(rows):
+        batches.append(rows)
+        return mynetdiary_columns(rows)
+
+    cache = ParseCache(str(tmp_path / 'db'))
+    emails = [mynetdiary, _mynetdiary_decoded]
+
+    first = cache.parse('mynetdiary', parser, emails, assemble=assemble)
+    second = cache.parse('mynetdiary', parser, emails, assemble=assemble)
+
+    assert repr(first) == repr(second) == repr(mynetdiary_parsing(emails))
+    assert len(calls) == 2
+    # Scanned rows are cached per email, and the rows of all emails are assembled as one batch.
+    assert len(batches) == 2
+    assert len(batches[0][0]) == 2 * len(mynetdiary_rows([mynetdiary])[0])
+
+    # Only results of the bumped parser are invalidated.
+    cache.parse('remarkable', reMarkableParsing().run, [remarkable])
+    monkeypatch.setitem(PARSER_VERSIONS, 'mynetdiary', '3')
+    cache.parse('mynetdiary', parser, emails, assemble=assemble)
+
+    assert len(calls) == 4
+
+    with closing(sqlite3.connect(cache.db_path)) as con:
+        assert con.execute("SELECT parser, version, COUNT(*) FROM parse_cache GROUP BY 1, 2").fetchall() == [
+            ('mynetdiary', '3', 2), ('remarkable', '1', 1)]
+
+    # Results used least recently are evicted first once the cache is full.
+    cache.max_bytes = 500
+    cache.parse('remarkable', reMarkableParsing().run, [_remarkable_decoded])
+
+    with closing(sqlite3.connect(cache.db_path)) as con:
+        assert con.execute("SELECT key FROM parse_cache").fetchall() == [
+            (cache.key('remarkable', '1', _remarkable_decoded),)]